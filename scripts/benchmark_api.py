@@ -0,0 +1,262 @@
+"""
+Offline load test and per-stage micro-benchmark for the pest classification API.
+
+Runs entirely in-process against `src/api/main.py`: no network, no Gemini key and no trained
+checkpoint needed. When MODEL_PATH doesn't exist, a seeded, randomly initialized ConvNeXt is
+saved to a temp file and used instead; the Gemini client is replaced by a stub with a
+configurable latency; the knowledge base is a temp copy, so write-through answers don't leak
+into the real one. API settings (BATCH_MAX_SIZE, INFERENCE_BACKEND, ...) are read from the
+environment as usual.
+
+    python scripts/benchmark_api.py --concurrency 16 --requests 256 --out bench.json
+"""
+import argparse, asyncio, datetime, io, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "api")
+STUB_RESPONSE = """# PEST INFO
+A sap-sucking insect that colonises young shoots and the underside of leaves, causing curling and stunted growth.
+
+# IPM SOLUTIONS
+- Spray neem seed kernel extract (5%) at early infestation.
+- Conserve **ladybird beetles** and lacewings.
+- Install yellow sticky traps.
+
+# CHEMICAL SOLUTIONS
+- Imidacloprid 17.8% SL: systemic, apply as per label.
+- Thiamethoxam 25% WG: systemic, apply as per label.
+- CRITICAL DISCLAIMER: check with local agricultural authorities for approved products and dosages.
+
+# PREVENTION TIPS
+- Remove and destroy infested shoots.
+- Avoid excess nitrogen fertiliser.
+"""
+
+
+class StubResponse:
+    def __init__(self, text): self.text = text
+
+
+class StubGenerativeModel:
+    """Stands in for genai.GenerativeModel: answers STUB_RESPONSE after `latency` seconds."""
+    latency = 0.5
+    stream_chunk_chars = 64
+
+    def __init__(self, *args, **kwargs): pass
+
+    async def generate_content_async(self, prompt, stream=False):
+        if not stream:
+            await asyncio.sleep(self.latency)
+            return StubResponse(STUB_RESPONSE)
+        chunks = [STUB_RESPONSE[i:i + self.stream_chunk_chars] for i in range(0, len(STUB_RESPONSE), self.stream_chunk_chars)]
+
+        async def chunk_stream():
+            for chunk in chunks:
+                await asyncio.sleep(self.latency / len(chunks))
+                yield StubResponse(chunk)
+        return chunk_stream()
+
+
+def summarize(latencies_s):
+    ordered = sorted(latencies_s)
+    def pct(p): return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def synthetic_jpegs(count, size, seed):
+    """Distinct, seeded JPEGs with some structure (smooth blocks plus noise), so decode cost is realistic."""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    images = []
+    width, height = size
+    for _ in range(count):
+        blocks = rng.integers(0, 256, (height // 64 + 1, width // 64 + 1, 3), dtype=np.uint8)
+        pixels = np.kron(blocks, np.ones((64, 64, 1), dtype=np.uint8))[:height, :width]
+        pixels = np.clip(pixels.astype(np.int16) + rng.integers(-12, 12, pixels.shape), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, "JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def prepare_environment(args, workdir):
+    """Points the API at offline stand-ins. Must run before `main` is imported."""
+    os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+    if not args.prediction_cache: os.environ["PREDICTION_CACHE_SIZE"] = "0"
+    kb_copy = os.path.join(workdir, "knowledge_base.db")
+    shutil.copy(os.path.join(API_DIR, "knowledge_base.db"), kb_copy)
+    os.environ["KNOWLEDGE_BASE_PATH"] = kb_copy
+
+    model_path = os.environ.get("MODEL_PATH", os.path.join(API_DIR, "../../models/convnext_pestopia_LLRD_best.pt"))
+    if os.path.exists(model_path):
+        return "checkpoint"
+    import torch, timm
+    torch.manual_seed(args.seed)
+    model = timm.create_model('convnext_tiny_in22k', pretrained=False, num_classes=132)
+    model_path = os.path.join(workdir, "random_convnext.pt")
+    torch.save(model.state_dict(), model_path)
+    os.environ["MODEL_PATH"] = model_path
+    return "random"
+
+
+async def drive(client, make_request, total, concurrency):
+    """Issues `total` requests with at most `concurrency` in flight; returns wall time, latencies and status counts."""
+    latencies, statuses = [], {}
+    counter = iter(range(total))
+
+    async def worker():
+        for index in counter:
+            start = time.perf_counter()
+            response = await make_request(client, index)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - start
+    return {"throughput_rps": round(total / wall, 2), "wall_s": round(wall, 3), "status_codes": statuses, "latency": summarize(latencies)}
+
+
+async def load_test(main, args, images):
+    import httpx
+    class_names = main.CLASS_NAMES
+
+    async def predict(client, index):
+        return await client.post("/predict", files={"file": (f"{index}.jpg", images[index % len(images)], "image/jpeg")})
+
+    async def recommend(client, index):
+        return await client.post("/recommend", json={"pest_name": class_names[index % len(class_names)]})
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        # The model loads in the background after start-up; wait for it like a load balancer would.
+        while (await client.get("/ready")).status_code != 200:
+            if main.readiness["status"] in ("unavailable", "failed"): raise RuntimeError(main.readiness["detail"])
+            await asyncio.sleep(0.05)
+        await predict(client, 0)  # first batch pays for lazy kernel initialisation
+        results = {
+            "predict": await drive(client, predict, args.requests, args.concurrency),
+            "recommend": await drive(client, recommend, args.requests, args.concurrency),
+        }
+        results["server_stats"] = (await client.get("/stats")).json()
+    return results
+
+
+def time_stage(fn, iterations):
+    fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter(); fn(); samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def stage_benchmarks(main, args, images):
+    import torch
+    import inference
+    from PIL import Image
+    from preprocessing import load_image, to_uint8_tensor, normalize_batch
+    from recommendation_parser import parse_recommendation
+
+    runner = inference._worker.get("model")
+    if runner is None:  # process executor: the API process holds no model of its own
+        runner, _ = inference.init_worker(
+            main.MODEL_PATH, main.NUM_CLASSES, main.CLASS_NAMES, main.INFERENCE_TORCH_THREADS,
+            backend=main.INFERENCE_BACKEND, channels_last=main.CHANNELS_LAST, export_dir=main.BACKEND_EXPORT_DIR,
+        )
+    size, iterations, batch = main.IMG_SIZE, args.stage_iterations, main.BATCH_MAX_SIZE
+    resized = load_image(images[0], size, main.MAX_IMAGE_PIXELS)
+    uint8_images = [to_uint8_tensor(resized)] * batch
+    logits = {}
+    data_transforms = main.build_data_transforms()
+
+    def forward(n):
+        def run():
+            with torch.inference_mode(): logits[n] = runner(normalize_batch(uint8_images[:n]))
+        return run
+
+    stages = {
+        "decode_full_resolution": time_stage(lambda: Image.open(io.BytesIO(images[0])).convert("RGB"), iterations),
+        "decode_draft_and_resize": time_stage(lambda: load_image(images[0], size, main.MAX_IMAGE_PIXELS), iterations),
+        "transform_data_transforms": time_stage(lambda: data_transforms(resized), iterations),
+        "transform_uint8_normalize": time_stage(lambda: normalize_batch([to_uint8_tensor(resized)]), iterations),
+        "forward_batch_1": time_stage(forward(1), iterations),
+        f"forward_batch_{batch}": time_stage(forward(batch), iterations),
+        f"softmax_topk_batch_{batch}": time_stage(lambda: torch.topk(torch.softmax(logits[batch], dim=1), 3, dim=1), iterations),
+        "response_parse": time_stage(lambda: parse_recommendation("Aphids", STUB_RESPONSE), iterations),
+    }
+    return stages
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=API_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="pest-bench-")
+    try:
+        weights = prepare_environment(args, workdir)
+        sys.path.insert(0, API_DIR)
+        os.chdir(API_DIR)
+        import torch
+        import main
+        StubGenerativeModel.latency = args.gemini_latency_ms / 1000.0
+        main.create_gemini_model = StubGenerativeModel
+        images = synthetic_jpegs(args.images, (args.image_width, args.image_height), args.seed)
+
+        async with main.app.router.lifespan_context(main.app):
+            load = await load_test(main, args, images)
+            stages = await asyncio.to_thread(stage_benchmarks, main, args, images)
+
+        settings = {name: getattr(main, name) for name in (
+            "BATCH_MAX_SIZE", "BATCH_MAX_WAIT_MS", "BATCH_MAX_QUEUE", "INFERENCE_EXECUTOR", "INFERENCE_MAX_CONCURRENCY",
+            "INFERENCE_TORCH_THREADS", "PREPROCESS_WORKERS", "INFERENCE_BACKEND", "CHANNELS_LAST", "PREDICTION_CACHE_SIZE",
+        )}
+        return {
+            "meta": {
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "git_commit": git_commit(),
+                "python": platform.python_version(), "torch": torch.__version__, "cpu_count": os.cpu_count(),
+                "weights": weights, "args": vars(args), "settings": settings,
+            },
+            "load": load,
+            "stages": stages,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test and stage micro-benchmarks for the pest API.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=128, help="requests per endpoint")
+    parser.add_argument("--images", type=int, default=16, help="distinct synthetic JPEGs to cycle through")
+    parser.add_argument("--image-width", type=int, default=1600)
+    parser.add_argument("--image-height", type=int, default=1200)
+    parser.add_argument("--gemini-latency-ms", type=float, default=500)
+    parser.add_argument("--stage-iterations", type=int, default=20)
+    parser.add_argument("--prediction-cache", action="store_true", help="keep the /predict cache on (off by default)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_results.json")
+    args = parser.parse_args()
+    args.out = os.path.abspath(args.out)
+
+    results = asyncio.run(run(args))
+    with open(args.out, "w") as f: json.dump(results, f, indent=2)
+    for endpoint in ("predict", "recommend"):
+        r = results["load"][endpoint]
+        print(f"{endpoint:>10}: {r['throughput_rps']} req/s  p50 {r['latency']['p50_ms']}ms  p95 {r['latency']['p95_ms']}ms  p99 {r['latency']['p99_ms']}ms")
+    for stage, r in results["stages"].items():
+        print(f"{stage:>28}: p50 {r['p50_ms']}ms  p95 {r['p95_ms']}ms")
+    print(f"✅ Results written to '{args.out}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Offline bulk classification of an image directory or tar archive, without going through /predict.
+
+    python scripts/classify_bulk.py traps/2024/ --out traps_2024.csv
+    python scripts/classify_bulk.py traps_2024.tar.gz --out traps_2024.parquet --decode-workers 8
+
+Uses the same classifier as the API: `src/api/main.py`'s MODEL_PATH, CLASS_NAMES, inference
+backend settings and `build_data_transforms()` preprocessing. Images are streamed in a stable
+order (sorted directory walk or tar member order), decoded by a process pool and classified in
+batches; results are appended to a CSV file, or written as part files into a `.parquet`
+directory, as they complete.
+
+Progress is checkpointed to `<out>.progress.json` every --checkpoint-every images, so an
+interrupted run picks up where it stopped: the first `done` images are skipped and anything
+written after the last checkpoint is discarded. Pass --restart to start over.
+"""
+import argparse, io, json, os, sys, tarfile, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "api")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+REPORT_EVERY_S = 10
+
+
+def iter_directory(root):
+    """(relative path, bytes) for every image under `root`, walking each directory in sorted order."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, root), lambda path=path: open(path, "rb").read()
+
+
+def iter_tar(path):
+    """(member name, bytes) for every image in a (possibly compressed) tar, read as a single stream."""
+    with tarfile.open(path, "r|*") as tar:
+        for member in tar:
+            if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.normpath(member.name), lambda member=member: tar.extractfile(member).read()
+
+
+def iter_images(source, skip=0):
+    """Yields (key, bytes) in a stable order, skipping the first `skip` images without reading them."""
+    items = iter_tar(source) if os.path.isfile(source) else iter_directory(source)
+    for index, (key, read) in enumerate(items):
+        if index >= skip: yield key, read()
+
+
+# --- Decode workers ---
+_decoder = {}
+
+def init_decoder(img_size, max_pixels):
+    sys.path.insert(0, API_DIR)
+    import torch
+    import main
+    torch.set_num_threads(1)
+    _decoder.update(transform=main.build_data_transforms(), img_size=img_size, max_pixels=max_pixels)
+
+
+def decode(contents):
+    """Returns (normalized (3, H, W) tensor, None), or (None, error message) for an unreadable image."""
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(contents)) as image:
+            if image.width * image.height > _decoder["max_pixels"]:
+                return None, f"Image is {image.width}x{image.height}; the limit is {_decoder['max_pixels']} pixels."
+            # JPEGs decode at the smallest DCT scale that still covers the model input, as in the API.
+            image.draft("RGB", (_decoder["img_size"], _decoder["img_size"]))
+            return _decoder["transform"](image.convert("RGB")), None
+    except Exception as e:
+        from preprocessing import image_error_detail
+        return None, image_error_detail(e) or f"Could not decode image: {type(e).__name__}"
+
+
+# --- Output ---
+class CsvOutput:
+    def __init__(self, path, columns, resume_bytes=None):
+        import csv
+        self.path = path
+        exists = resume_bytes is not None and os.path.exists(path)
+        self._file = open(path, "r+" if exists else "w", newline="")
+        if exists:
+            # Drop rows written after the last checkpoint; they are classified again.
+            self._file.truncate(resume_bytes)
+            self._file.seek(resume_bytes)
+        self._writer = csv.writer(self._file)
+        if not exists: self._writer.writerow(columns)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"csv_bytes": self._file.tell()}
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetOutput:
+    """A directory of part files, one per checkpoint, readable as one dataset (pandas / pyarrow / duckdb)."""
+
+    def __init__(self, path, columns, next_part=0):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow. Install it with `pip install pyarrow`, or write a .csv instead.")
+        self._pa, self._pq = pyarrow, pyarrow.parquet
+        self.path, self.columns, self.next_part = path, columns, next_part
+        # Explicit, so parts where a column happens to be all-null still share one schema.
+        self._schema = pyarrow.schema([(name, pyarrow.float64() if name.startswith("confidence") else pyarrow.string()) for name in columns])
+        os.makedirs(path, exist_ok=True)
+        # Parts from after the last checkpoint are classified again.
+        for filename in os.listdir(path):
+            if filename.startswith("part-") and int(filename[5:10]) >= next_part: os.remove(os.path.join(path, filename))
+        self._rows = []
+
+    def write(self, rows):
+        self._rows.extend(rows)
+
+    def checkpoint(self):
+        if self._rows:
+            table = self._pa.Table.from_pylist([dict(zip(self.columns, row)) for row in self._rows], schema=self._schema)
+            part = os.path.join(self.path, f"part-{self.next_part:05d}.parquet")
+            self._pq.write_table(table, part + ".tmp")
+            os.replace(part + ".tmp", part)
+            self.next_part += 1
+            self._rows = []
+        return {"parts": self.next_part}
+
+    def close(self):
+        pass
+
+
+def load_progress(path, source):
+    if not os.path.exists(path): return None
+    with open(path) as f: progress = json.load(f)
+    if progress["source"] != source:
+        raise RuntimeError(f"'{path}' belongs to a run over '{progress['source']}'. Use --restart or another --out.")
+    return progress
+
+
+def save_progress(path, progress):
+    with open(path + ".tmp", "w") as f: json.dump(progress, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def classify_all(args):
+    sys.path.insert(0, API_DIR)
+    os.chdir(API_DIR)  # main.py's default paths are relative to src/api
+    import main
+    from inference import init_worker, classify_in_worker
+
+    progress_path = args.out + ".progress.json"
+    if args.restart and os.path.exists(progress_path): os.remove(progress_path)
+    progress = load_progress(progress_path, args.source) or {"source": args.source, "done": 0, "errors": 0}
+    if progress["done"]: print(f"--- Resuming after {progress['done']} images ---")
+
+    if progress["done"] and not os.path.exists(args.out):
+        raise RuntimeError(f"'{args.out}' is missing but '{progress_path}' says {progress['done']} images are done. Use --restart.")
+    columns = ["path"] + [f"{field}_{rank}" for rank in range(1, args.top_k + 1) for field in ("class", "confidence")] + ["stage", "error"]
+    if args.out.endswith(".parquet"):
+        output = ParquetOutput(args.out, columns, progress.get("parts", 0))
+    else:
+        output = CsvOutput(args.out, columns, progress.get("csv_bytes") if progress["done"] else None)
+
+    if not os.path.exists(main.MODEL_PATH):
+        raise RuntimeError(f"Local pest classifier not found at {main.MODEL_PATH}")
+    init_worker(
+        main.MODEL_PATH, main.NUM_CLASSES, main.CLASS_NAMES, args.threads or main.INFERENCE_TORCH_THREADS,
+        backend=main.INFERENCE_BACKEND, channels_last=main.CHANNELS_LAST, export_dir=main.BACKEND_EXPORT_DIR,
+        img_size=main.IMG_SIZE, cascade=main.CASCADE,
+    )
+
+    def classify(batch):
+        """Classifies the decoded images of `batch` and returns its output rows, in order."""
+        images = [tensor for _, tensor, _ in batch if tensor is not None]
+        results = iter(classify_in_worker(images, k=args.top_k)[0] if images else [])
+        rows = []
+        for key, tensor, error in batch:
+            if tensor is None:
+                rows.append([key] + [None] * (2 * args.top_k) + [None, error])
+                continue
+            result = next(results)
+            ranked = [value for p in result["predictions"] for value in (p["class_name"], p["confidence"])]
+            rows.append([key] + ranked + [result["stage"], None])
+        return rows
+
+    start = last_report = time.perf_counter()
+    processed = since_report = since_checkpoint = 0
+    window = args.decode_workers * args.batch_size * 2
+    pending, batch = deque(), []
+
+    def flush(force=False):
+        nonlocal since_checkpoint
+        if batch:
+            rows = classify(batch)
+            output.write(rows)
+            progress["done"] += len(rows)
+            progress["errors"] += sum(1 for row in rows if row[-1])
+            since_checkpoint += len(rows)
+            batch.clear()
+        if since_checkpoint and (force or since_checkpoint >= args.checkpoint_every):
+            progress.update(output.checkpoint())
+            save_progress(progress_path, progress)
+            since_checkpoint = 0
+
+    with ProcessPoolExecutor(
+        max_workers=args.decode_workers, mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_decoder, initargs=(main.IMG_SIZE, main.MAX_IMAGE_PIXELS),
+    ) as decoders:
+        images = iter_images(args.source, skip=progress["done"])
+        exhausted = False
+        while pending or not exhausted:
+            # Keep the decoders busy with up to `window` images while this process runs forward passes.
+            while not exhausted and len(pending) < window:
+                item = next(images, None)
+                if item is None: exhausted = True
+                else: pending.append((item[0], decoders.submit(decode, item[1])))
+            if not pending: break
+            key, future = pending.popleft()
+            tensor, error = future.result()
+            batch.append((key, tensor, error))
+            if len(batch) >= args.batch_size:
+                processed += len(batch); since_report += len(batch)
+                flush()
+            now = time.perf_counter()
+            if now - last_report >= REPORT_EVERY_S:
+                print(f"--- {progress['done']} images done, {since_report / (now - last_report):.1f} images/s "
+                      f"(run average {processed / (now - start):.1f}) ---")
+                last_report, since_report = now, 0
+        processed += len(batch)
+        flush(force=True)
+    output.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ Classified {processed} images in {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.1f} images/s); "
+          f"{progress['done']} total, {progress['errors']} unreadable. Results in '{args.out}'.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify a directory or tar archive of pest images in bulk.")
+    parser.add_argument("source", help="image directory or .tar / .tar.gz archive")
+    parser.add_argument("--out", required=True, help="results file: .csv, or .parquet (written as a directory of parts)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--decode-workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--threads", type=int, default=None, help="torch threads for the forward passes (default: as the API)")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="images between progress checkpoints")
+    parser.add_argument("--restart", action="store_true", help="ignore saved progress and start over")
+    args = parser.parse_args()
+    args.source, args.out = os.path.abspath(args.source), os.path.abspath(args.out)
+    try:
+        classify_all(args)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
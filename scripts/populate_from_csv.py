@@ -1,6 +1,14 @@
+import argparse
+import datetime
+import os
 import sqlite3
+import sys
+
 import pandas as pd
-import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "api"))
+from database_setup import apply_schema, apply_indexes
+from prediction_cache import file_sha256
 
 DB_NAME = "src/api/knowledge_base.db"
 CSV_PATH = "cibrc_data.csv"
@@ -8,64 +16,78 @@ SOURCE_NAME = "CIB&RC"
 RECOMMENDATION_TYPE = "Chemical"
 LAST_VERIFIED = datetime.date.today().isoformat()
 
-def populate_db_from_csv():
+def populate_db_from_csv(csv_path=CSV_PATH, db_path=DB_NAME, force=False):
     """
-    Reads the scraped CIB&RC data from the CSV and inserts it into the database.
+    Bulk-loads the scraped CIB&RC data from the CSV into the database.
+
+    Idempotent and incremental: recommendations are upserted on (PestID, RecommendationDetails,
+    Source), so re-running never duplicates rows, and a CSV whose content hash matches the last
+    ingested one is skipped entirely unless `force` is set.
     """
+    conn = None
     try:
-        # Load the scraped data
-        df = pd.read_csv(CSV_PATH)
+        content_hash = file_sha256(csv_path)
+        source_key = os.path.abspath(csv_path)
 
-        # Connect to the database
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(db_path)
+        apply_schema(conn)
+        apply_indexes(conn, verbose=True)
         cursor = conn.cursor()
 
-        print(f"--- Populating database from '{CSV_PATH}' ---")
-
-        inserted_count = 0
-        # Use a set to keep track of pests we've already added
-        known_pests = set(row[0] for row in cursor.execute("SELECT PestCommonName FROM pests"))
-
-        for _, row in df.iterrows():
-            # Normalize the pest name to be consistent
-            pest_name = str(row['pest_name']).strip().lower().replace(' ', '_')
-            chemical = str(row['chemical_name']).strip()
-            dosage = str(row['dosage']).strip()
+        last = cursor.execute("SELECT ContentHash FROM ingest_log WHERE SourcePath = ?", (source_key,)).fetchone()
+        if last and last[0] == content_hash and not force:
+            print(f"✅ '{csv_path}' is unchanged since the last ingest. Nothing to do.")
+            return
 
-            # Full recommendation detail
-            recommendation_detail = f"{chemical} (Dosage: {dosage})"
+        # Load the scraped data
+        df = pd.read_csv(csv_path)
+        # Same text as str(value) per cell, so missing values keep matching the rows already stored
+        column = lambda name: df[name].astype(object).map(str).str.strip()
+        print(f"--- Populating database from '{csv_path}' ({len(df)} rows) ---")
 
-            # 1. Insert the pest into the 'pests' table if it's new
-            if pest_name not in known_pests:
-                cursor.execute(
-                    "INSERT INTO pests (PestCommonName) VALUES (?)",
-                    (pest_name,)
-                )
-                known_pests.add(pest_name)
+        # Normalize the pest name to be consistent
+        pest_names = column('pest_name').str.lower().str.replace(' ', '_')
+        details = column('chemical_name') + " (Dosage: " + column('dosage') + ")"
 
-            # 2. Get the PestID for the current pest
-            cursor.execute("SELECT PestID FROM pests WHERE PestCommonName = ?", (pest_name,))
-            result = cursor.fetchone()
-            if result is None:
-                continue # Should not happen, but as a safeguard
-            pest_id = result[0]
+        # Everything below is one transaction: a failed run leaves the database untouched.
+        with conn:
+            # 1. Insert every new pest in one statement, then resolve all PestIDs in memory
+            cursor.executemany(
+                "INSERT OR IGNORE INTO pests (PestCommonName) VALUES (?)",
+                ((name,) for name in pest_names.unique()),
+            )
+            pest_ids = dict(cursor.execute("SELECT PestCommonName, PestID FROM pests"))
 
-            # 3. Insert the chemical recommendation
-            cursor.execute("""
-                INSERT INTO recommendations 
+            # 2. Upsert the chemical recommendations; existing ones just get re-verified
+            before = cursor.execute("SELECT COUNT(*) FROM recommendations").fetchone()[0]
+            cursor.executemany("""
+                INSERT INTO recommendations
                 (PestID, RecommendationType, RecommendationDetails, Source, LastVerifiedDate)
                 VALUES (?, ?, ?, ?, ?)
-            """, (pest_id, RECOMMENDATION_TYPE, recommendation_detail, SOURCE_NAME, LAST_VERIFIED))
-            inserted_count += 1
+                ON CONFLICT (PestID, RecommendationDetails, Source) DO UPDATE SET LastVerifiedDate = excluded.LastVerifiedDate
+            """, (
+                (pest_ids[name], RECOMMENDATION_TYPE, detail, SOURCE_NAME, LAST_VERIFIED)
+                for name, detail in zip(pest_names, details)
+            ))
+            inserted_count = cursor.execute("SELECT COUNT(*) FROM recommendations").fetchone()[0] - before
+
+            cursor.execute(
+                "INSERT OR REPLACE INTO ingest_log (SourcePath, ContentHash, RowCount, IngestedAt) VALUES (?, ?, ?, ?)",
+                (source_key, content_hash, len(df), datetime.datetime.now(datetime.timezone.utc).isoformat()),
+            )
 
-        conn.commit()
         print(f"✅ Database population complete. Inserted {inserted_count} new chemical recommendations.")
 
-    except (sqlite3.Error, pd.errors.EmptyDataError, FileNotFoundError) as e:
+    except (sqlite3.Error, pd.errors.EmptyDataError, FileNotFoundError, KeyError) as e:
         print(f"❌ An error occurred: {e}")
     finally:
         if conn:
             conn.close()
 
 if __name__ == "__main__":
-    populate_db_from_csv()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Bulk-load cibrc_data.csv into the knowledge base.")
+    parser.add_argument("--csv", default=CSV_PATH)
+    parser.add_argument("--db", default=DB_NAME)
+    parser.add_argument("--force", action="store_true", help="re-ingest even if the CSV is unchanged")
+    args = parser.parse_args()
+    populate_db_from_csv(args.csv, args.db, args.force)
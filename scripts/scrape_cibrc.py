@@ -1,11 +1,25 @@
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import requests
 import pdfplumber
-import pandas as pd
-import os
+from pdfminer.pdftypes import resolve1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "api"))
+from prediction_cache import file_sha256
 
 PDF_URL = "https://ppqs.gov.in/sites/default/files/major_uses_of_pesticides_insecticides_as_on_31.03.2024.pdf"
 PDF_PATH = "cibrc_pesticides.pdf"
 CSV_PATH = "cibrc_data.csv"
+CACHE_DIR = "cibrc_pages"
+CSV_COLUMNS = ['chemical_name', 'pest_name', 'crop_name', 'dosage']
 
 def download_pdf(url, path):
     """Downloads a PDF from a given URL."""
@@ -25,68 +39,137 @@ def download_pdf(url, path):
         print(f"❌ Failed to download PDF: {e}")
         return False
 
-def parse_pdf_to_csv(pdf_path, csv_path):
+def select_columns(row):
     """
-    Parses the downloaded PDF with more robust logic to handle
-    tables with varying column counts.
+    Maps one table row to (chemical_name, pest_name, crop_name, dosage), or None if the row has
+    no pest or crop. The first 5 cells are S_No, Insecticide, Pest, Crop, Dosage; any extra,
+    inconsistent columns are ignored and missing ones count as empty.
+    """
+    cells = (row + [''] * 5)[:5]
+    chemical, pest, crop, dosage = cells[1:5]
+    if not pest.strip() or not crop.strip():
+        return None
+    return [chemical, pest, crop, dosage]
+
+# --- Page workers: each process opens the PDF once and extracts the pages it is handed ---
+_worker = {}
+
+def _init_worker(pdf_path, pdf_hash, cache_dir):
+    _worker.update(pdf_path=pdf_path, pdf_hash=pdf_hash, cache_dir=cache_dir, pdf=None)
+
+def _page_digest(page):
+    """Hash of the page's raw content streams and size; unchanged pages of a new revision keep it."""
+    digest = hashlib.sha256(repr(page.page_obj.mediabox).encode())
+    contents = page.page_obj.contents
+    for stream in contents if isinstance(contents, list) else [contents]:
+        digest.update(resolve1(stream).get_data())
+    return digest.hexdigest()
+
+def _cache_path(page_number):
+    return os.path.join(_worker["cache_dir"], f"page-{page_number:05d}.json")
+
+def extract_page(page_number):
+    """
+    Returns the selected rows of one (0-based) page. A cached result is reused when it was
+    written for the same PDF, or for an older revision whose copy of this page is identical.
+    """
+    path = _cache_path(page_number)
+    cached = None
+    if os.path.exists(path):
+        with open(path) as f:
+            cached = json.load(f)
+        if cached["pdf_hash"] == _worker["pdf_hash"]:
+            return cached["rows"], True
+
+    if _worker["pdf"] is None:
+        _worker["pdf"] = pdfplumber.open(_worker["pdf_path"])
+    page = _worker["pdf"].pages[page_number]
+    try:
+        digest = _page_digest(page)
+        reused = cached is not None and cached["page_digest"] == digest
+        if reused:
+            rows = cached["rows"]
+        else:
+            rows = []
+            for table in page.extract_tables():
+                # Skip header rows
+                for row in table[1:]:
+                    # Clean the row of None values and newlines
+                    selected = select_columns([str(cell).replace('\n', ' ') if cell is not None else '' for cell in row])
+                    if selected: rows.append(selected)
+    finally:
+        page.close()
+
+    # Write-then-rename, so a crash mid-write never leaves a truncated cache entry behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"pdf_hash": _worker["pdf_hash"], "page_digest": digest, "rows": rows}, f)
+    os.replace(tmp_path, path)
+    return rows, reused
+
+def iter_pages_in_order(executor, page_count, window):
+    """Yields (page_number, result) in page order, keeping at most `window` pages in flight."""
+    pending = deque()
+    next_page = 0
+    while next_page < page_count or pending:
+        while next_page < page_count and len(pending) < window:
+            pending.append((next_page, executor.submit(extract_page, next_page)))
+            next_page += 1
+        page_number, future = pending.popleft()
+        yield page_number, future.result()
+
+def parse_pdf_to_csv(pdf_path, csv_path, workers=None, cache_dir=CACHE_DIR):
+    """
+    Extracts the tables page by page across a process pool and streams the rows to the CSV in page
+    order, so memory stays flat regardless of the document size. Every page's rows are cached in
+    `cache_dir`, so a re-run after a crash, or against a new revision of the PDF, only re-extracts
+    the pages that are missing or changed.
     """
     if not os.path.exists(pdf_path):
         print(f"❌ PDF file not found at '{pdf_path}'. Cannot parse.")
         return
 
     print(f"--- 📖 Parsing data from '{pdf_path}' ---")
-    all_data = []
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_csv_path = f"{csv_path}.tmp"
     try:
+        pdf_hash = file_sha256(pdf_path)
         with pdfplumber.open(pdf_path) as pdf:
-            for i, page in enumerate(pdf.pages):
-                print(f"  -> Processing page {i+1}/{len(pdf.pages)}...")
-                tables = page.extract_tables()
-                for table in tables:
-                    # Skip header rows
-                    for row in table[1:]:
-                        # Clean the row of None values and newlines
-                        cleaned_row = [str(cell).replace('\n', ' ') if cell is not None else '' for cell in row]
-                        all_data.append(cleaned_row)
-        
-        if not all_data:
-            print("❌ No tables were extracted from the PDF.")
-            return
+            page_count = len(pdf.pages)
 
-        # --- THIS IS THE FIX ---
-        # Create a DataFrame without specifying columns first, to handle varying lengths.
-        df = pd.DataFrame(all_data)
+        record_count = cached_pages = 0
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(pdf_path, pdf_hash, cache_dir),
+        ) as executor, open(tmp_csv_path, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(CSV_COLUMNS)
+            for page_number, (rows, cached) in iter_pages_in_order(executor, page_count, window=2 * workers):
+                print(f"  -> Processed page {page_number+1}/{page_count}{' (cached)' if cached else ''}...")
+                writer.writerows(rows)
+                record_count += len(rows)
+                cached_pages += cached
 
-        # We assume the first 5 columns are the most important ones.
-        # This is a robust way to handle tables with extra, inconsistent columns.
-        num_columns = df.shape[1]
-        if num_columns < 4:
-            print(f"❌ Aborting: Found tables with fewer than 4 columns. Check PDF structure.")
+        if not record_count:
+            os.remove(tmp_csv_path)
+            print("❌ No tables were extracted from the PDF.")
             return
-            
-        # Select the first 4 or 5 columns which typically contain the key info
-        # This avoids errors if some tables have more columns
-        col_count_to_use = min(5, num_columns)
-        df = df.iloc[:, :col_count_to_use]
-
-        # Assign column names based on the expected structure
-        column_names = ['S_No', 'Insecticide', 'Pest', 'Crop', 'Dosage']
-        df.columns = column_names[:col_count_to_use]
-
-        # Select and rename the final columns we need
-        df = df[['Insecticide', 'Pest', 'Crop', 'Dosage']]
-        df.columns = ['chemical_name', 'pest_name', 'crop_name', 'dosage']
-
-        # Final data cleaning
-        df = df.dropna(subset=['pest_name', 'crop_name'])
-        df = df[df['pest_name'].str.strip() != '']
-        df = df[df['crop_name'].str.strip() != '']
 
-        df.to_csv(csv_path, index=False)
-        print(f"✅ Data successfully parsed and saved to '{csv_path}'. Found {len(df)} records.")
+        # Only replace the previous CSV once every page has been written
+        os.replace(tmp_csv_path, csv_path)
+        print(f"✅ Data successfully parsed and saved to '{csv_path}'. Found {record_count} records "
+              f"({cached_pages}/{page_count} pages from cache).")
 
     except Exception as e:
         print(f"❌ An error occurred during PDF parsing: {e}")
 
 if __name__ == "__main__":
-    if download_pdf(PDF_URL, PDF_PATH):
-        parse_pdf_to_csv(PDF_PATH, CSV_PATH)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Download the CIB&RC insecticide PDF and extract it to CSV.")
+    parser.add_argument("--pdf", default=PDF_PATH)
+    parser.add_argument("--csv", default=CSV_PATH)
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes (default: all cores)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="per-page extraction cache")
+    args = parser.parse_args()
+    if download_pdf(PDF_URL, args.pdf):
+        parse_pdf_to_csv(args.pdf, args.csv, args.workers, args.cache_dir)
@@ -0,0 +1,214 @@
+"""
+Optimized CPU inference backends for the pest classifier.
+
+Every backend wraps the eager ConvNeXt and is exposed as a callable `backend(batch) -> logits`,
+so `inference.classify_batch` doesn't care which one it runs. A backend is only used after
+`check_parity` confirms its top-1 / top-3 predictions match eager on a sample set.
+
+Exports are reproducible: `python backends.py export --backend onnx` (or torchscript) writes
+the artifact plus a JSON manifest recording the checkpoint hash, torch version and opset.
+"""
+import argparse, inspect, json, os
+from contextlib import contextmanager
+import torch
+from PIL import Image
+from prediction_cache import file_sha256
+try:
+    import fcntl
+except ImportError:  # Windows: exports aren't locked across processes
+    fcntl = None
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx", "int8")
+ONNX_OPSET = 17
+EXPORT_SEED = 0
+
+
+class TorchBackend:
+    def __init__(self, name, module, channels_last=True):
+        self.name, self.module, self.channels_last = name, module, channels_last
+
+    def __call__(self, batch):
+        if self.channels_last: batch = batch.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            return self.module(batch)
+
+
+class OnnxBackend:
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("The 'onnx' backend needs onnxruntime. Install it with `pip install onnxruntime`.")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads: options.intra_op_num_threads = num_threads
+        self.name = "onnx"
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        logits = self.session.run(None, {self.input_name: batch.detach().cpu().contiguous().numpy()})[0]
+        return torch.from_numpy(logits)
+
+
+def _example_input(img_size, batch_size=1):
+    generator = torch.Generator().manual_seed(EXPORT_SEED)
+    return torch.randn(batch_size, 3, img_size, img_size, generator=generator)
+
+
+def _manifest(model_path, backend, **extra):
+    return {"backend": backend, "checkpoint_sha256": file_sha256(model_path), "torch": torch.__version__, **extra}
+
+
+def _export_is_current(artifact, manifest):
+    """True if `artifact` exists and was exported from the same checkpoint with the same toolchain."""
+    try:
+        with open(artifact + ".json") as f: return os.path.exists(artifact) and json.load(f) == manifest
+    except (OSError, ValueError):
+        return False
+
+
+@contextmanager
+def _export_lock(path):
+    """Holds `<path>.lock`, so workers starting together export once and the others wait for it."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        if fcntl: fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _publish_export(path, manifest, write):
+    """
+    Writes the artifact via `write(tmp_path)` and the manifest to temp files and renames them into
+    place, manifest last, so a process loading `path` never sees a partly written or mismatched one.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+    with open(tmp_path, "w") as f: json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path + ".json")
+
+
+def export_onnx(model, model_path, path, img_size):
+    manifest = _manifest(model_path, "onnx", opset=ONNX_OPSET, img_size=img_size)
+    if _export_is_current(path, manifest): return path
+    with _export_lock(path):
+        # Another process may have exported it while this one waited for the lock.
+        if _export_is_current(path, manifest): return path
+        kwargs = {}
+        # Newer torch defaults to the dynamo exporter; the TorchScript exporter gives stable graphs across runs.
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters: kwargs["dynamo"] = False
+        _publish_export(path, manifest, lambda tmp_path: torch.onnx.export(
+            model.eval(), _example_input(img_size), tmp_path, input_names=["input"], output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}}, opset_version=ONNX_OPSET,
+            do_constant_folding=True, **kwargs,
+        ))
+    print(f"✅ Exported ONNX model to '{path}'.")
+    return path
+
+
+def export_torchscript(model, model_path, path, img_size, channels_last=True):
+    manifest = _manifest(model_path, "torchscript", img_size=img_size, channels_last=channels_last)
+    if _export_is_current(path, manifest): return torch.jit.load(path, map_location="cpu")
+    with _export_lock(path):
+        if _export_is_current(path, manifest): return torch.jit.load(path, map_location="cpu")
+        example = _example_input(img_size)
+        if channels_last: example = example.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+        _publish_export(path, manifest, lambda tmp_path: torch.jit.save(scripted, tmp_path))
+    print(f"✅ Exported TorchScript model to '{path}'.")
+    return scripted
+
+
+def build_backend(name, model, model_path, img_size, export_dir, channels_last=True, num_threads=None):
+    """Wraps an eager, eval-mode CPU model in the requested backend."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}'. Choose one of {', '.join(BACKENDS)}.")
+    if channels_last and name != "onnx": model = model.to(memory_format=torch.channels_last)
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    if name == "eager":
+        return TorchBackend("eager", model, channels_last)
+    if name == "torchscript":
+        module = export_torchscript(model, model_path, os.path.join(export_dir, f"{stem}.torchscript.pt"), img_size, channels_last)
+        return TorchBackend("torchscript", module, channels_last)
+    if name == "compile":
+        return TorchBackend("compile", torch.compile(model), channels_last)
+    if name == "int8":
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return TorchBackend("int8", quantized, channels_last)
+    path = export_onnx(model, model_path, os.path.join(export_dir, f"{stem}.onnx"), img_size)
+    return OnnxBackend(path, num_threads)
+
+
+def select_backend(name, model, model_path, img_size, export_dir, channels_last=True, num_threads=None,
+                   transform=None, sample_dir=None):
+    """Builds the requested backend and accepts it only if it passes `check_parity`; otherwise falls back to eager."""
+    reference = TorchBackend("eager", model, channels_last=False)
+    try:
+        candidate = build_backend(name, model, model_path, img_size, export_dir, channels_last, num_threads)
+    except Exception as e:
+        print(f"❌ ERROR: Could not build '{name}' inference backend, falling back to eager. Error: {e}")
+        return reference
+    if name == "eager" and not channels_last: return candidate
+    ok, report = check_parity(reference, candidate, parity_samples(img_size, transform, sample_dir))
+    if not ok:
+        print(f"❌ ERROR: '{name}' backend failed the parity check against eager {report}. Falling back to eager.")
+        return reference
+    print(f"✅ Using '{name}' inference backend (channels_last={channels_last}). Parity: {report}")
+    return candidate
+
+
+def parity_samples(img_size, transform=None, sample_dir=None, count=8):
+    """
+    Sample batch for parity checks: up to `count` images from `sample_dir` (preprocessed with
+    `transform`), topped up with seeded random inputs so the check also runs without a sample set.
+    """
+    samples = []
+    if sample_dir and transform and os.path.isdir(sample_dir):
+        for filename in sorted(os.listdir(sample_dir)):
+            if len(samples) >= count: break
+            try:
+                with Image.open(os.path.join(sample_dir, filename)) as image:
+                    samples.append(transform(image.convert("RGB")))
+            except OSError:
+                continue
+    if len(samples) < count:
+        samples.extend(_example_input(img_size, count - len(samples)))
+    return torch.stack(samples)
+
+
+def check_parity(reference, candidate, samples, k=3, min_top1=1.0, min_topk=1.0):
+    """
+    Compares `candidate` against the eager `reference` on `samples`. Returns (ok, report), where
+    the report holds the fraction of samples whose top-1 class and top-k class set agree.
+    """
+    with torch.inference_mode():
+        expected = reference(samples).topk(k, dim=1).indices
+        actual = candidate(samples).topk(k, dim=1).indices
+    top1 = (expected[:, 0] == actual[:, 0]).float().mean().item()
+    topk = sum(set(e) == set(a) for e, a in zip(expected.tolist(), actual.tolist())) / len(samples)
+    report = {"samples": len(samples), "top1_agreement": round(top1, 4), f"top{k}_agreement": round(topk, 4)}
+    return top1 >= min_top1 and topk >= min_topk, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the pest classifier to an optimized inference backend.")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--backend", choices=["onnx", "torchscript"], required=True)
+    parser.add_argument("--model-path", default=os.getenv("MODEL_PATH", "../../models/convnext_pestopia_LLRD_best.pt"))
+    parser.add_argument("--export-dir", default=os.getenv("BACKEND_EXPORT_DIR", "../../models/exported"))
+    parser.add_argument("--num-classes", type=int, default=132)
+    parser.add_argument("--img-size", type=int, default=224)
+    args = parser.parse_args()
+
+    from inference import load_classifier
+    torch.manual_seed(EXPORT_SEED)
+    model = load_classifier(args.model_path, args.num_classes, torch.device("cpu"))
+    backend = build_backend(args.backend, model, args.model_path, args.img_size, args.export_dir)
+    ok, report = check_parity(TorchBackend("eager", model, False), backend, parity_samples(args.img_size))
+    print(f"{'✅' if ok else '❌'} Parity vs eager: {report}")
+
+
+if __name__ == "__main__":
+    main()
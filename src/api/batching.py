@@ -0,0 +1,133 @@
+import asyncio, time
+from collections import deque
+
+
+class QueueFullError(Exception):
+    """Raised when the batching queue cannot accept more work."""
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent inference requests into batches.
+
+    Callers `await submit(item)`; a single background task drains the queue, waits up
+    to `max_wait_ms` for a batch to fill to `max_batch_size`, hands the whole batch to
+    `process_batch(items) -> results` and resolves each caller's future with its own result.
+
+    With a `pool` (see executor.WorkerPool) batches run off the event loop, at most
+    `max_concurrent_batches` at a time; while every slot is busy the queue keeps filling,
+    so the next batch comes out larger instead of more batches contending for the CPU.
+
+    With `on_batch`, `process_batch` returns (results, info) instead, and `on_batch(info, batch_size)`
+    is called on the event loop once per batch, e.g. to record timings measured in the worker.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait_ms=5.0, max_queue_size=64,
+                 pool=None, max_concurrent_batches=1, on_batch=None):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.pool = pool
+        self.max_concurrent_batches = max_concurrent_batches
+        self.on_batch = on_batch
+        self._queue = None
+        self._worker = None
+        self._slots = None
+        self._in_flight = set()
+        self._batch_sizes = deque(maxlen=1000)
+        self._stats = {"requests": 0, "batches": 0, "rejected": 0, "errors": 0}
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            try: await self._worker
+            except asyncio.CancelledError: pass
+        if self._in_flight: await asyncio.gather(*self._in_flight, return_exceptions=True)
+        while self._queue and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done(): future.set_exception(RuntimeError("Batcher stopped."))
+        self._worker = None
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def submit(self, item):
+        """Queues one item and waits for its result. Raises QueueFullError when saturated."""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self._stats["rejected"] += 1
+            raise QueueFullError(f"Inference queue is full ({self.max_queue_size} pending).")
+        self._stats["requests"] += 1
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try: batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError: break
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release(); raise
+            # Callers that gave up (e.g. client disconnected) don't need a forward pass.
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                self._slots.release(); continue
+            task = asyncio.create_task(self._dispatch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, batch):
+        self._stats["batches"] += 1
+        self._batch_sizes.append(len(batch))
+        try:
+            results = await self._process([item for item, _ in batch])
+            if self.on_batch: results, info = results; self.on_batch(info, len(batch))
+            results = list(results)
+            if len(results) != len(batch):
+                raise RuntimeError(f"process_batch returned {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            # Every caller gets an answer, whichever step failed; none is left waiting.
+            self._stats["errors"] += 1
+            for _, future in batch:
+                if not future.done(): future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for (_, future), result in zip(batch, results):
+            if not future.done(): future.set_result(result)
+
+    async def _process(self, items):
+        if self.pool: return await self.pool.run(self.process_batch, items)
+        return self.process_batch(items)
+
+    def stats(self):
+        sizes = sorted(self._batch_sizes)
+        return {
+            **self._stats,
+            "queue_depth": self.queue_depth,
+            "max_queue_size": self.max_queue_size,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches_in_flight": len(self._in_flight),
+            "recent_batch_size_mean": round(sum(sizes) / len(sizes), 2) if sizes else 0.0,
+            "recent_batch_size_p50": sizes[len(sizes) // 2] if sizes else 0,
+            "recent_batch_size_max": sizes[-1] if sizes else 0,
+        }
@@ -2,28 +2,17 @@ import sqlite3
 
 DB_NAME = "knowledge_base.db"
 
-def create_database():
-    """
-    Creates a new SQLite database with the schema for our knowledge base.
-    """
-    try:
-        # Connect to the database (this will create the file if it doesn't exist)
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-
-        print("--- Creating 'pests' table ---")
-        cursor.execute("""
+SCHEMA = [
+    ("pests", """
         CREATE TABLE IF NOT EXISTS pests (
             PestID INTEGER PRIMARY KEY AUTOINCREMENT,
             PestCommonName TEXT NOT NULL UNIQUE,
             PestScientificName TEXT,
             PestInfo TEXT
         );
-        """)
-
-        print("--- Creating 'recommendations' table ---")
-        # This table is based on the structure from the research document
-        cursor.execute("""
+    """),
+    # This table is based on the structure from the research document
+    ("recommendations", """
         CREATE TABLE IF NOT EXISTS recommendations (
             RecommendationID INTEGER PRIMARY KEY AUTOINCREMENT,
             PestID INTEGER,
@@ -33,10 +22,82 @@ def create_database():
             LastVerifiedDate TEXT,
             FOREIGN KEY (PestID) REFERENCES pests (PestID)
         );
-        """)
+    """),
+    # Parsed Gemini answers for pests without curated data, so each is only generated once
+    ("recommendation_cache", """
+        CREATE TABLE IF NOT EXISTS recommendation_cache (
+            PestKey TEXT PRIMARY KEY,
+            Payload TEXT NOT NULL,
+            Source TEXT NOT NULL,
+            CreatedAt TEXT NOT NULL
+        );
+    """),
+    # Content hash of each ingested source file, so unchanged inputs can be skipped
+    ("ingest_log", """
+        CREATE TABLE IF NOT EXISTS ingest_log (
+            SourcePath TEXT PRIMARY KEY,
+            ContentHash TEXT NOT NULL,
+            RowCount INTEGER,
+            IngestedAt TEXT NOT NULL
+        );
+    """),
+]
 
-        # Commit the changes to the database
-        conn.commit()
+# PestID leads the unique key, so it also serves every "recommendations for this pest" lookup.
+INDEXES = [
+    ("idx_recommendations_pest_details_source", """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_recommendations_pest_details_source
+        ON recommendations (PestID, RecommendationDetails, Source);
+    """),
+]
+
+# Full-text index over each pest's names, description and recommendation text; rowid is the PestID.
+# The API builds it in memory at start-up (see knowledge_base.PestCatalog), not in the database file,
+# with one document per pest: rows whose names only differ in case or underscores are merged.
+SEARCH_INDEX = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS pest_search USING fts5(
+        PestCommonName, PestScientificName, PestInfo, Recommendations,
+        tokenize = 'unicode61 remove_diacritics 2'
+    );
+"""
+
+def apply_schema(conn, verbose=False):
+    """
+    Creates any missing tables on an open connection. Safe to run against an existing database.
+    """
+    cursor = conn.cursor()
+    for table, ddl in SCHEMA:
+        if verbose: print(f"--- Creating '{table}' table ---")
+        cursor.execute(ddl)
+    conn.commit()
+
+def apply_indexes(conn, verbose=False):
+    """
+    Creates the lookup / uniqueness indexes, first dropping duplicate recommendations left behind
+    by older, non-idempotent ingestion runs (the lowest RecommendationID of each group is kept).
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        DELETE FROM recommendations WHERE RecommendationID NOT IN (
+            SELECT MIN(RecommendationID) FROM recommendations GROUP BY PestID, RecommendationDetails, Source
+        );
+    """)
+    if verbose and cursor.rowcount: print(f"--- Removed {cursor.rowcount} duplicate recommendations ---")
+    for index, ddl in INDEXES:
+        if verbose: print(f"--- Creating index '{index}' ---")
+        cursor.execute(ddl)
+    conn.commit()
+
+def create_database():
+    """
+    Creates a new SQLite database with the schema for our knowledge base.
+    """
+    conn = None
+    try:
+        # Connect to the database (this will create the file if it doesn't exist)
+        conn = sqlite3.connect(DB_NAME)
+        apply_schema(conn, verbose=True)
+        apply_indexes(conn, verbose=True)
         print(f"✅ Database '{DB_NAME}' and tables created successfully.")
 
     except sqlite3.Error as e:
@@ -46,4 +107,4 @@ def create_database():
             conn.close()
 
 if __name__ == "__main__":
-    create_database()
\ No newline at end of file
+    create_database()
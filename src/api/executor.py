@@ -0,0 +1,43 @@
+import asyncio, contextvars, multiprocessing, os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+
+def default_torch_threads(concurrency):
+    """Splits the available cores between `concurrency` simultaneous forward passes."""
+    return max(1, (os.cpu_count() or 1) // max(1, concurrency))
+
+
+class WorkerPool:
+    """
+    Runs blocking, CPU-heavy callables (image decode, forward passes) off the asyncio
+    event loop, in either a thread pool or a spawned process pool.
+
+    Process workers run `initializer(*initargs)` once on start-up, which is where the
+    model gets loaded; callables submitted to a process pool must be picklable.
+    """
+
+    def __init__(self, kind="thread", workers=1, name="worker", initializer=None, initargs=()):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind '{kind}'. Use 'thread' or 'process'.")
+        self.kind, self.workers = kind, workers
+        if kind == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=initializer, initargs=initargs,
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=name,
+                initializer=initializer, initargs=initargs,
+            )
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = partial(fn, *args, **kwargs)
+        # Thread workers see the caller's context variables, e.g. the per-request timings in metrics.py.
+        if self.kind == "thread": call = partial(contextvars.copy_context().run, call)
+        return await loop.run_in_executor(self._executor, call)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,214 @@
+import argparse, os, time
+import torch
+from backends import TorchBackend, select_backend
+from preprocessing import normalize_batch
+from metrics import startup_phase
+
+# Per-process state: the model used by `classify_in_worker`. Populated by `init_worker`,
+# either in the API process itself (thread executor) or in each spawned worker process.
+_worker = {}
+
+
+def load_state_dict(model_path):
+    """
+    Checkpoint weights, memory-mapped instead of read into freshly allocated tensors: `.safetensors`
+    files via safetensors, anything else via `torch.load(mmap=True)`, which needs a zip-format
+    checkpoint (the torch.save default since 1.6); legacy checkpoints are read the old way.
+    """
+    if model_path.endswith(".safetensors"):
+        try:
+            from safetensors.torch import load_file
+        except ImportError:
+            raise RuntimeError("Loading a .safetensors checkpoint needs safetensors. Install it with `pip install safetensors`.")
+        return load_file(model_path, device="cpu")
+    try:
+        return torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        return torch.load(model_path, map_location="cpu", weights_only=True)
+
+
+def load_classifier(model_path, num_classes, device, arch='convnext_tiny_in22k'):
+    """Builds the ConvNeXt classifier (or another timm `arch`) and loads its weights. Raises FileNotFoundError if the checkpoint is missing."""
+    import timm  # deferred: timm pulls in torchvision, and only processes that build the model need it
+    # Built on the meta device, so no time is spent randomly initializing weights that are replaced
+    # right away; `assign=True` then adopts the (memory-mapped) checkpoint tensors without a copy.
+    with torch.device("meta"):
+        model = timm.create_model(arch, pretrained=False, num_classes=num_classes)
+    model.load_state_dict(load_state_dict(model_path), assign=True)
+    model.to(device); model.eval()
+    return model
+
+
+def convert_to_safetensors(model_path, output_path=None):
+    """Writes the checkpoint's state dict as a .safetensors file next to it (or to `output_path`)."""
+    from safetensors.torch import save_file
+    output_path = output_path or model_path.rsplit(".", 1)[0] + ".safetensors"
+    state_dict = torch.load(model_path, map_location="cpu", weights_only=True)
+    save_file({name: tensor.contiguous() for name, tensor in state_dict.items()}, output_path)
+    return output_path
+
+
+def save_shared_weights(model_path, output_path, channels_last=True):
+    """
+    Re-saves the checkpoint's weights in the layout the serving model uses (4-D conv weights already
+    channels_last). Processes that load the result through `load_state_dict` memory-map it and run
+    on the file's pages directly, so workers share one physical copy of nearly all the weights;
+    the depthwise `conv_dw` weights (C, 1, 7, 7) are still re-laid out, and so copied, in each worker.
+    """
+    state_dict = load_state_dict(model_path)
+    if channels_last:
+        state_dict = {name: t.contiguous(memory_format=torch.channels_last) if t.dim() == 4 else t for name, t in state_dict.items()}
+    tmp_path = f"{output_path}.tmp"
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def init_worker(model_path, num_classes, class_names, torch_threads=None, model=None, backend="eager",
+                channels_last=True, export_dir="exported", img_size=224, parity_transform=None, parity_dir=None,
+                cascade=None, source_path=None):
+    """
+    Prepares this process for `classify_in_worker`: loads the model unless one is passed in and
+    wraps it in the requested inference backend (see backends.py). Returns (runner, device).
+    Backend exports are named and hashed after `source_path`, the original checkpoint, when
+    `model_path` is a copy of it (e.g. serve.py's shared weights file).
+
+    `cascade` enables cascade inference (see `run_cascade`): a dict with `threshold`, `audit_rate`,
+    `img_size` and optionally `model_path` / `model_arch` of a smaller first-stage classifier.
+    """
+    if torch_threads: torch.set_num_threads(torch_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if model is None:
+        with startup_phase("load_weights"):
+            model = load_classifier(model_path, num_classes, device)
+    if device.type == "cpu":
+        with startup_phase("select_backend"):
+            model = select_backend(
+                backend, model, source_path or model_path, img_size, export_dir, channels_last=channels_last,
+                num_threads=torch_threads, transform=parity_transform, sample_dir=parity_dir,
+            )
+    if cascade:
+        with startup_phase("cascade_stage"):
+            cascade = load_cascade_stage(cascade, model, num_classes, device, channels_last)
+    _worker.update(model=model, device=device, class_names=class_names, cascade=cascade)
+    return model, device
+
+
+def load_cascade_stage(cascade, model, num_classes, device, channels_last=True):
+    """
+    Returns `cascade` with its first-stage runner under "model": a smaller classifier when
+    `model_path` is set, otherwise the full model itself at `img_size`. Returns None (cascade off)
+    if that stage can't run, e.g. an ONNX export whose input size is fixed at the full resolution.
+    """
+    cascade = dict(cascade)
+    try:
+        if cascade.get("model_path"):
+            small = load_classifier(cascade["model_path"], num_classes, device, arch=cascade["model_arch"])
+            if channels_last: small = small.to(memory_format=torch.channels_last)
+            cascade["model"] = TorchBackend("eager", small, channels_last)
+        else:
+            cascade["model"] = model
+        with torch.no_grad():
+            cascade["model"](torch.zeros(1, 3, cascade["img_size"], cascade["img_size"], device=device))
+    except Exception as e:
+        print(f"❌ ERROR: Could not set up the cascade's first stage, running the full model only. Error: {e}")
+        return None
+    print(f"✅ Cascade inference on: {'small model' if cascade.get('model_path') else 'full model'} at "
+          f"{cascade['img_size']}px first, full model below {cascade['threshold']} confidence.")
+    return cascade
+
+
+def classify_in_worker(images, k=3):
+    """
+    Returns (per-image results, info) for one batch: each result is {"predictions", "stage"}, and
+    info holds the stage timings in seconds plus, in cascade mode, the cascade counts.
+    """
+    info = {"timings": {}}
+    if _worker["cascade"]: info["cascade"] = {}
+    results = classify_batch(
+        _worker["model"], images, _worker["device"], _worker["class_names"], k=k, timings=info["timings"],
+        cascade=_worker["cascade"], cascade_counts=info.get("cascade"),
+    )
+    return results, info
+
+
+def warm_up(batch_sizes, img_size=224):
+    """
+    Runs throwaway batches through this worker's model so one-off costs (oneDNN primitive creation,
+    allocator growth, the preallocated batch buffer) are paid before the first real request.
+    """
+    for batch_size in batch_sizes:
+        classify_in_worker([torch.zeros(img_size, img_size, 3, dtype=torch.uint8)] * batch_size)
+
+
+def run_cascade(model, batch, k, cascade, counts=None):
+    """
+    Cascade inference over a normalized batch; returns (top-k confidences, top-k indices, stages).
+
+    The first stage (`cascade["model"]` at `cascade["img_size"]`) answers every image whose top-1
+    softmax confidence reaches `cascade["threshold"]`; only the rest go through the full model. A
+    random `audit_rate` share of the accepted images is re-run on the full model anyway, purely to
+    measure how often the first stage agrees with it. `counts` receives images / escalated /
+    audited / audit_agreed / escalation_changed for tuning the threshold.
+    """
+    size = cascade["img_size"]
+    fast_batch = batch
+    if batch.shape[-1] != size:
+        fast_batch = torch.nn.functional.interpolate(batch, size=(size, size), mode="bilinear", antialias=True, align_corners=False)
+    confidences, indices = torch.topk(torch.nn.functional.softmax(cascade["model"](fast_batch), dim=1), k, dim=1)
+    accepted = confidences[:, 0] >= cascade["threshold"]
+    audited = accepted & (torch.rand(len(batch), device=accepted.device) < cascade["audit_rate"])
+    rows = torch.nonzero(~accepted | audited).flatten()
+    if len(rows):
+        full_confidences, full_indices = torch.topk(torch.nn.functional.softmax(model(batch[rows]), dim=1), k, dim=1)
+        agreed = full_indices[:, 0] == indices[rows, 0]
+        escalated = ~accepted[rows]
+        confidences[rows[escalated]] = full_confidences[escalated]
+        indices[rows[escalated]] = full_indices[escalated]
+        if counts is not None:
+            counts.update(audited=int((~escalated).sum()), audit_agreed=int((agreed & ~escalated).sum()),
+                          escalation_changed=int((~agreed & escalated).sum()))
+    if counts is not None:
+        counts.update(images=len(batch), escalated=int((~accepted).sum()))
+        for key in ("audited", "audit_agreed", "escalation_changed"): counts.setdefault(key, 0)
+    return confidences, indices, ["fast" if ok else "full" for ok in accepted.tolist()]
+
+
+def classify_batch(model, images, device, class_names, k=3, timings=None, cascade=None, cascade_counts=None):
+    """
+    Classifies a list of images and returns one {"predictions": top-k list, "stage": "fast" | "full"}
+    per image, in input order. Images are either uint8 (H, W, 3) tensors from
+    preprocessing.preprocess_upload or already-normalized (C, H, W) float tensors, e.g. from
+    `main.build_data_transforms()`. Without `cascade` every image takes one full-model forward
+    pass. Per-stage durations are added to `timings` when a dict is passed.
+    """
+    marks = [time.perf_counter()]
+    batch = normalize_batch(images) if images[0].dtype == torch.uint8 else torch.stack(images)
+    marks.append(time.perf_counter())
+    batch = batch.to(device)
+    marks.append(time.perf_counter())
+    with torch.no_grad():
+        if cascade:
+            topk_conf, topk_indices, stages = run_cascade(model, batch, k, cascade, cascade_counts)
+            marks.append(time.perf_counter())
+        else:
+            outputs = model(batch)
+            marks.append(time.perf_counter())
+            topk_conf, topk_indices = torch.topk(torch.nn.functional.softmax(outputs, dim=1), k, dim=1)
+            stages = ["full"] * len(images)
+    marks.append(time.perf_counter())
+    if timings is not None:
+        for stage, start, end in zip(("batch_normalize", "device_transfer", "forward", "softmax_topk"), marks, marks[1:]):
+            timings[stage] = end - start
+    return [
+        {"predictions": [{"class_name": class_names[idx], "confidence": round(conf, 4)} for idx, conf in zip(indices, confs)], "stage": stage}
+        for indices, confs, stage in zip(topk_indices.tolist(), topk_conf.tolist(), stages)
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a classifier checkpoint for faster, memory-mapped loading.")
+    parser.add_argument("command", choices=["to-safetensors"])
+    parser.add_argument("checkpoint")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    print(f"✅ Wrote {convert_to_safetensors(args.checkpoint, args.output)}")
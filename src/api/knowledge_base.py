@@ -0,0 +1,387 @@
+import asyncio, datetime, json, pathlib, queue, re, sqlite3, threading
+from contextlib import contextmanager
+from database_setup import SCHEMA, SEARCH_INDEX
+from recommendation_parser import PAYLOAD_SECTIONS
+
+CHEMICAL_DOSAGE = re.compile(r'^(.*?)\s*\(Dosage:\s*(.*)\)\s*$')
+
+
+def normalize_pest_name(name):
+    """Common key for the classifier's labels, /recommend input and `pests.PestCommonName`."""
+    return " ".join(str(name).replace('_', ' ').lower().split())
+
+
+def _in_clause(ids):
+    return f"IN ({', '.join('?' * len(ids))})"
+
+
+def _read_uri(db_path):
+    return f"{pathlib.Path(db_path).resolve().as_uri()}?mode=ro"
+
+
+def _build_aliases(pests):
+    """
+    Normalized name -> the PestIDs (oldest first) of every row known by it. Rows whose names only
+    differ in case or underscores are kept together, and common names win over scientific names.
+    """
+    by_column = ({}, {})
+    for pest_id, *names in pests:
+        for aliases, name in zip(by_column, names):
+            if name: aliases.setdefault(normalize_pest_name(name), []).append(pest_id)
+    common, scientific = by_column
+    return {key: tuple(ids) for key, ids in {**scientific, **common}.items()}
+
+
+class ReadPool:
+    """
+    A fixed set of read-only SQLite connections shared by request threads, so read queries don't
+    pay for a connect and schema load each time. Callers block while every connection is in use.
+    """
+
+    def __init__(self, db_path, size=4):
+        uri = _read_uri(db_path)
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(sqlite3.connect(uri, uri=True, timeout=10, check_same_thread=False))
+
+    @contextmanager
+    def connection(self):
+        conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while not self._idle.empty(): self._idle.get_nowait().close()
+
+
+class PestCatalog:
+    """
+    Resolves pest names to `pests.PestID` and serves the read-only /pests and /search queries.
+
+    `sync(class_names)` runs once at start-up and only reads the database. It maps every
+    normalized common name and scientific name to the rows known by it, maps each classifier label
+    to its pest (None for labels the knowledge base has no row for), and builds the FTS5 index in
+    memory, so resolving a name is a dict lookup. A name can resolve to several rows (e.g. 'brown
+    plant hopper' and 'brown_plant_hopper'); lookups and search read all of them as one pest.
+    """
+
+    def __init__(self, db_path, pool_size=4):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.aliases = {}
+        self.label_ids = {}
+        self.known_names = frozenset()
+        self.search_enabled = False
+        self._canonical_ids = {}
+        self._names = {}
+        self._scientific_names = {}
+        self._search_index = None
+        self._search_lock = threading.Lock()
+        self._pool = None
+
+    def sync(self, class_names):
+        try:
+            conn = sqlite3.connect(_read_uri(self.db_path), uri=True, timeout=10)
+            try:
+                pests = conn.execute("SELECT PestID, PestCommonName, PestScientificName FROM pests ORDER BY PestID").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # Classification must not depend on the knowledge base: run with an empty catalog instead.
+            print(f"❌ ERROR: Knowledge base '{self.db_path}' is unavailable, /pests and /search are off. Error: {e}")
+            self.label_ids = dict.fromkeys(class_names)
+            self.known_names = frozenset(normalize_pest_name(label) for label in class_names)
+            return
+        self.aliases = _build_aliases(pests)
+        # Every row reports as the oldest row sharing its common name.
+        self._canonical_ids = {pest_id: (self.pest_ids(common_name) or (pest_id,))[0] for pest_id, common_name, _ in pests}
+        self._names = {pest_id: common_name for pest_id, common_name, _ in pests}
+        # As in `get_pest`: a merged pest's scientific name is the first one any of its rows has.
+        self._scientific_names = {}
+        for pest_id, _, scientific_name in pests:
+            if scientific_name: self._scientific_names.setdefault(self._canonical_ids[pest_id], scientific_name)
+        self.label_ids = {label: self.pest_id(label) for label in class_names}
+        self.known_names = frozenset(self.aliases).union(normalize_pest_name(label) for label in class_names)
+        try:
+            self._search_index = self._build_search_index()
+            self.search_enabled = True
+        except sqlite3.OperationalError as e:
+            print(f"❌ ERROR: Full-text search is unavailable: {e}")
+        if self._pool is None: self._pool = ReadPool(self.db_path, self.pool_size)
+
+    def _build_search_index(self):
+        """
+        An in-memory FTS5 index with one document per pest, rows sharing a common name merged under
+        the oldest one's PestID, so start-up never adds tables to the knowledge base file.
+        """
+        index = sqlite3.connect(":memory:", uri=True, check_same_thread=False)
+        try:
+            index.execute("ATTACH DATABASE ? AS kb", (_read_uri(self.db_path),))
+            rows = index.execute("""
+                SELECT p.PestID, replace(p.PestCommonName, '_', ' '), p.PestScientificName, p.PestInfo,
+                       group_concat(r.RecommendationDetails, ' | ')
+                FROM kb.pests p LEFT JOIN kb.recommendations r ON r.PestID = p.PestID
+                GROUP BY p.PestID ORDER BY p.PestID
+            """).fetchall()
+            index.execute("DETACH DATABASE kb")
+            documents = {}
+            for pest_id, *fields in rows:
+                document = documents.setdefault(self._canonical_ids.get(pest_id, pest_id), ([], [], [], []))
+                for values, value in zip(document, fields):
+                    if value and value not in values: values.append(value)
+            with index:
+                index.execute(SEARCH_INDEX)
+                index.executemany(
+                    "INSERT INTO pest_search (rowid, PestCommonName, PestScientificName, PestInfo, Recommendations) VALUES (?, ?, ?, ?, ?)",
+                    [(pest_id, *(" | ".join(values) for values in document)) for pest_id, document in documents.items()],
+                )
+        except sqlite3.Error:
+            index.close()
+            raise
+        if self._search_index: self._search_index.close()
+        return index
+
+    @property
+    def available(self):
+        """False until a `sync` has read the database."""
+        return self._pool is not None
+
+    def connection(self):
+        return self._pool.connection()
+
+    def close(self):
+        if self._pool: self._pool.close()
+        if self._search_index: self._search_index.close()
+
+    def pest_ids(self, name):
+        return self.aliases.get(normalize_pest_name(name), ())
+
+    def knows(self, name):
+        """True for a classifier label or any name of a pest in the knowledge base."""
+        return normalize_pest_name(name) in self.known_names
+
+    def pest_id(self, name):
+        pest_ids = self.pest_ids(name)
+        return pest_ids[0] if pest_ids else None
+
+    def get_pest(self, name):
+        """The pest with its aliases and recommendations, or None if `name` isn't known."""
+        key = normalize_pest_name(name)
+        with self.connection() as conn:
+            pest_ids = self.aliases.get(key)
+            if not pest_ids:
+                # Rows ingested since start-up aren't aliased yet; try the stored spellings of the name.
+                rows = conn.execute(
+                    "SELECT PestID FROM pests WHERE PestCommonName IN (?, ?) ORDER BY PestID", (key, key.replace(' ', '_'))
+                ).fetchall()
+                if not rows: return None
+                pest_ids = tuple(pest_id for (pest_id,) in rows)
+            in_ids = _in_clause(pest_ids)
+            pests = conn.execute(
+                f"SELECT PestID, PestCommonName, PestScientificName, PestInfo FROM pests WHERE PestID {in_ids} ORDER BY PestID", pest_ids
+            ).fetchall()
+            if not pests: return None
+            recommendations = [
+                {"type": rec_type, "details": details, "source": source, "last_verified": verified}
+                for rec_type, details, source, verified in conn.execute(
+                    f"SELECT RecommendationType, RecommendationDetails, Source, LastVerifiedDate FROM recommendations WHERE PestID {in_ids} ORDER BY RecommendationID",
+                    pest_ids,
+                )
+            ]
+        ids = {pest[0] for pest in pests}
+        aliases = sorted(alias for alias, alias_ids in self.aliases.items() if ids.intersection(alias_ids))
+        # The oldest row names the pest; the other fields come from the first row that has them.
+        pest_id, common_name = pests[0][:2]
+        scientific_name, pest_info = (next((pest[column] for pest in pests if pest[column]), None) for column in (2, 3))
+        return {
+            "pest_id": pest_id, "pest_ids": [pest[0] for pest in pests], "pest_name": common_name, "scientific_name": scientific_name,
+            "pest_info": pest_info, "aliases": aliases, "recommendations": recommendations,
+        }
+
+    def search(self, query, limit=20):
+        """
+        Ranked full-text matches over pest names, descriptions and recommendation text. Every word
+        in `query` must match, as a prefix; FTS5 query syntax in the input is treated as plain text.
+        """
+        terms = re.findall(r"\w+", query)
+        if not terms: return []
+        match = " ".join(f'"{term}"*' for term in terms)
+        with self._search_lock:
+            rows = self._search_index.execute("""
+                SELECT rowid, snippet(pest_search, -1, '[', ']', '…', 12), bm25(pest_search, 10.0, 10.0, 2.0, 1.0) AS rank
+                FROM pest_search WHERE pest_search MATCH ? ORDER BY rank LIMIT ?
+            """, (match, limit)).fetchall()
+        return [
+            {
+                "pest_id": pest_id, "pest_name": self._names[pest_id].replace('_', ' '), "scientific_name": self._scientific_names.get(pest_id),
+                "snippet": snippet, "score": round(-rank, 4),
+            }
+            for pest_id, snippet, rank in rows
+        ]
+
+
+class RecommendationStore:
+    """
+    Answers /recommend from knowledge_base.db before falling back to Gemini.
+
+    Lookup order: curated `pests` / `recommendations` rows, then previously generated answers in
+    `recommendation_cache`, then `generate()`. Generated payloads for classifier labels and known
+    pests are written through to the cache table, and concurrent misses for the same pest share a
+    single upstream call (single-flight). With a synced `PestCatalog`, names resolve through its
+    aliases and lookups use its read pool.
+    """
+
+    def __init__(self, db_path, cache_ttl_days=30, catalog=None):
+        self.db_path = db_path
+        self.cache_ttl_days = cache_ttl_days
+        self.catalog = catalog
+        self._in_flight = {}
+        self._stats = {"curated_hits": 0, "cache_hits": 0, "misses": 0, "coalesced": 0, "generation_errors": 0}
+        try:
+            with self._connect() as conn: conn.execute(dict(SCHEMA)["recommendation_cache"])
+        except sqlite3.Error as e:
+            print(f"❌ ERROR: Could not prepare the recommendation cache in '{db_path}'. Error: {e}")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn: yield conn
+        finally:
+            conn.close()
+
+    def _curated_pest_ids(self, conn, key):
+        if self.catalog: return self.catalog.pest_ids(key)
+        rows = conn.execute("SELECT PestID FROM pests WHERE lower(replace(PestCommonName, '_', ' ')) = ? ORDER BY PestID", (key,))
+        return tuple(pest_id for (pest_id,) in rows)
+
+    def _lookup_curated(self, conn, key, pest_name):
+        pest_ids = self._curated_pest_ids(conn, key)
+        if not pest_ids: return None
+        in_ids = _in_clause(pest_ids)
+        row = conn.execute(
+            f"SELECT PestInfo FROM pests WHERE PestID {in_ids} AND PestInfo IS NOT NULL AND PestInfo != '' ORDER BY PestID LIMIT 1", pest_ids
+        ).fetchone()
+        if row is None: return None
+        pest_info = row[0]
+        payload = {"pest_name": pest_name, "pest_info": pest_info, "ipm_solutions": [], "chemical_solutions": [], "prevention_tips": []}
+        for rec_type, details, source in conn.execute(
+            f"SELECT RecommendationType, RecommendationDetails, Source FROM recommendations WHERE PestID {in_ids} ORDER BY RecommendationID",
+            pest_ids,
+        ):
+            if rec_type == "IPM": payload["ipm_solutions"].append(details)
+            elif rec_type == "Prevention": payload["prevention_tips"].append(details)
+            elif rec_type == "Chemical":
+                match = CHEMICAL_DOSAGE.match(details)
+                pesticide, dosage = (match.group(1), match.group(2)) if match else (details, "As per local guidelines")
+                notes = f"Source: {source}." if source else "Consult packaging for detailed information."
+                payload["chemical_solutions"].append({"pesticide": pesticide, "dosage": dosage, "notes": notes})
+        return payload
+
+    def _lookup_cached(self, conn, key):
+        row = conn.execute("SELECT Payload, CreatedAt FROM recommendation_cache WHERE PestKey = ?", (key,)).fetchone()
+        if row is None: return None
+        payload, created_at = row
+        if self.cache_ttl_days:
+            age = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(created_at)
+            if age > datetime.timedelta(days=self.cache_ttl_days): return None
+        return json.loads(payload)
+
+    def lookup(self, pest_name):
+        """Returns (payload, source) from the database, or (None, None) on a miss."""
+        key = normalize_pest_name(pest_name)
+        with (self.catalog.connection() if self.catalog and self.catalog.available else self._connect()) as conn:
+            payload = self._lookup_curated(conn, key, pest_name)
+            if payload is not None: return payload, "knowledge_base"
+            payload = self._lookup_cached(conn, key)
+            if payload is not None: return payload, "cache"
+        return None, None
+
+    def cacheable(self, pest_name):
+        """
+        Whether a generated answer for `pest_name` may be written to `recommendation_cache`: only for
+        classifier labels and known pests, so arbitrary /recommend input can't grow the table.
+        """
+        if self.catalog: return self.catalog.knows(pest_name)
+        with self._connect() as conn: return bool(self._curated_pest_ids(conn, normalize_pest_name(pest_name)))
+
+    def save(self, pest_name, payload, source="gemini"):
+        """Writes a generated answer to the cache table, first dropping answers that are past the TTL."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._connect() as conn:
+            if self.cache_ttl_days:
+                expired_before = (now - datetime.timedelta(days=self.cache_ttl_days)).isoformat()
+                conn.execute("DELETE FROM recommendation_cache WHERE CreatedAt < ?", (expired_before,))
+            conn.execute(
+                "INSERT OR REPLACE INTO recommendation_cache (PestKey, Payload, Source, CreatedAt) VALUES (?, ?, ?, ?)",
+                (normalize_pest_name(pest_name), json.dumps(payload), source, now.isoformat()),
+            )
+
+    async def _lookup_counted(self, pest_name):
+        payload, source = await asyncio.to_thread(self.lookup, pest_name)
+        if source == "knowledge_base": self._stats["curated_hits"] += 1
+        if source == "cache": self._stats["cache_hits"] += 1
+        return payload
+
+    def _join_or_start(self, pest_name, generate):
+        """Returns (task, started): the in-flight generation for this pest, starting one if there is none."""
+        key = normalize_pest_name(pest_name)
+        task = self._in_flight.get(key)
+        if task is not None:
+            self._stats["coalesced"] += 1
+            return task, False
+        self._stats["misses"] += 1
+        task = asyncio.create_task(self._generate_and_save(pest_name, generate))
+        self._in_flight[key] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return task, True
+
+    async def get(self, pest_name, generate):
+        """
+        Returns the recommendation payload for `pest_name`, calling `await generate()` only on a
+        database miss. The result is persisted before it is returned.
+        """
+        payload = await self._lookup_counted(pest_name)
+        if payload is not None: return payload
+        task, _ = self._join_or_start(pest_name, generate)
+        # Shielded so a caller that disconnects doesn't cancel the call for everyone else waiting on it.
+        return await asyncio.shield(task)
+
+    async def stream(self, pest_name, generate_stream):
+        """
+        Async generator of (section, value) pairs for `pest_name`. Database hits and coalesced
+        callers get every section at once; the caller that triggers generation gets each section as
+        `await generate_stream(emit)` reports it via `emit(section, value)` and returns the payload.
+        """
+        payload = await self._lookup_counted(pest_name)
+        sections = asyncio.Queue()
+
+        async def generate():
+            try:
+                return await generate_stream(lambda section, value: sections.put_nowait((section, value)))
+            finally:
+                sections.put_nowait(None)
+
+        if payload is None:
+            task, started = self._join_or_start(pest_name, generate)
+            if started:
+                while (item := await sections.get()) is not None: yield item
+            payload = await asyncio.shield(task)
+            if started: return
+        for section in PAYLOAD_SECTIONS: yield section, payload[section]
+
+    async def _generate_and_save(self, pest_name, generate):
+        try:
+            payload = await generate()
+        except Exception:
+            self._stats["generation_errors"] += 1
+            raise
+        # Don't pin an answer that failed to parse; the next request should try again.
+        if any(payload.get(section) for section in PAYLOAD_SECTIONS[1:]) and await asyncio.to_thread(self.cacheable, pest_name):
+            await asyncio.to_thread(self.save, pest_name, payload)
+        return payload
+
+    def stats(self):
+        return {**self._stats, "in_flight": len(self._in_flight)}
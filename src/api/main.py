@@ -1,19 +1,88 @@
-import torch, timm, io, os, re
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import time
+IMPORT_START = time.perf_counter()
+import asyncio, importlib, json, os
+from typing import List
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.base import BaseHTTPMiddleware
 from pydantic import BaseModel
-from PIL import Image
-from torchvision import transforms
 from contextlib import asynccontextmanager
-import google.generativeai as genai
 from dotenv import load_dotenv
+from functools import partial
+from batching import MicroBatcher, QueueFullError
+from executor import WorkerPool, default_torch_threads
+from preprocessing import UploadTooLarge, image_error_detail, read_upload, load_image, to_uint8_tensor, preprocess_upload
+from knowledge_base import PestCatalog, RecommendationStore
+from metrics import (
+    REGISTRY, ERRORS_TOTAL, CACHE_EVENTS, CASCADE_IMAGES, QUEUE_DEPTH, STARTUP_PHASES,
+    TimingMiddleware, timed, record, record_batch, record_startup_phase, startup_phase,
+)
+from recommendation_parser import SectionParser, parse_recommendation
+from prediction_cache import PredictionCache, model_version, content_hash, perceptual_hash
+
+IMPORT_DONE = time.perf_counter()
+
+load_dotenv()
 
 # --- Configuration for Local Development ---
-MODEL_PATH = "../../models/convnext_pestopia_LLRD_best.pt"
+MODEL_PATH = os.getenv("MODEL_PATH", "../../models/convnext_pestopia_LLRD_best.pt")
+MODEL_SOURCE_PATH = os.getenv("MODEL_SOURCE_PATH")  # the original checkpoint when MODEL_PATH is serve.py's shared copy
 NUM_CLASSES = 132
 IMG_SIZE = 224
 
+# --- Micro-batching (override via environment / .env) ---
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 8))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 5))
+BATCH_MAX_QUEUE = int(os.getenv("BATCH_MAX_QUEUE", 64))
+BATCH_RETRY_AFTER_S = int(os.getenv("BATCH_RETRY_AFTER_S", 1))
+
+# --- Executors: keep decode and forward passes off the event loop ---
+INFERENCE_EXECUTOR = os.getenv("INFERENCE_EXECUTOR", "thread")  # "thread" or "process"
+INFERENCE_MAX_CONCURRENCY = int(os.getenv("INFERENCE_MAX_CONCURRENCY", 1))  # forward passes running at once
+INFERENCE_TORCH_THREADS = int(os.getenv("INFERENCE_TORCH_THREADS", 0)) or default_torch_threads(INFERENCE_MAX_CONCURRENCY)
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", 4))
+WARMUP_BATCH_SIZE = int(os.getenv("WARMUP_BATCH_SIZE", BATCH_MAX_SIZE))  # warmup runs batches of 1 and this; 0 skips it
+
+# --- Inference backend: eager, torchscript, compile, onnx or int8 (see backends.py) ---
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+CHANNELS_LAST = os.getenv("CHANNELS_LAST", "1") == "1"
+BACKEND_EXPORT_DIR = os.getenv("BACKEND_EXPORT_DIR", "../../models/exported")
+PARITY_SAMPLES_DIR = os.getenv("PARITY_SAMPLES_DIR")  # optional folder of real images for the parity check
+
+# --- Cascade inference: a cheap first stage answers confident images, the full model the rest ---
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "0") == "1"
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", 0.8))  # first-stage top-1 confidence needed to skip the full model
+CASCADE_IMG_SIZE = int(os.getenv("CASCADE_IMG_SIZE", 160))  # first-stage input resolution
+CASCADE_AUDIT_RATE = float(os.getenv("CASCADE_AUDIT_RATE", 0.05))  # share of accepted images re-checked on the full model
+CASCADE_MODEL_PATH = os.getenv("CASCADE_MODEL_PATH")  # optional smaller first-stage checkpoint; default is the full model at CASCADE_IMG_SIZE
+CASCADE_MODEL_ARCH = os.getenv("CASCADE_MODEL_ARCH", "convnext_atto")  # timm architecture of CASCADE_MODEL_PATH
+CASCADE = {
+    "threshold": CASCADE_THRESHOLD, "img_size": CASCADE_IMG_SIZE, "audit_rate": CASCADE_AUDIT_RATE,
+    "model_path": CASCADE_MODEL_PATH, "model_arch": CASCADE_MODEL_ARCH,
+} if CASCADE_ENABLED else None
+
+# --- Prediction cache: "sha256" matches identical uploads, "phash" also re-encoded copies ---
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", 2048))  # 0 disables the cache
+PREDICTION_CACHE_TTL_S = float(os.getenv("PREDICTION_CACHE_TTL_S", 3600))
+PREDICTION_CACHE_MODE = os.getenv("PREDICTION_CACHE_MODE", "sha256")
+
+# --- Knowledge base: /recommend answers from SQLite first, Gemini only on a miss ---
+KNOWLEDGE_BASE_PATH = os.getenv("KNOWLEDGE_BASE_PATH", "knowledge_base.db")
+RECOMMENDATION_CACHE_TTL_DAYS = float(os.getenv("RECOMMENDATION_CACHE_TTL_DAYS", 30))  # 0 keeps answers forever
+KNOWLEDGE_BASE_READ_POOL = int(os.getenv("KNOWLEDGE_BASE_READ_POOL", 4))  # read-only connections for /pests and /search
+
+# --- Upload limits, enforced while reading / from the image header ---
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 15)) * (1 << 20)
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 50_000_000))
+
+# --- /predict/batch ---
+PREDICT_BATCH_MAX_FILES = int(os.getenv("PREDICT_BATCH_MAX_FILES", 64))
+PREDICT_BATCH_IN_FLIGHT = int(os.getenv("PREDICT_BATCH_IN_FLIGHT", BATCH_MAX_SIZE * 2))  # per request
+
 ml_models = {}
+readiness = {"status": "starting", "detail": None}
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL_S, PREDICTION_CACHE_MODE)
 CLASS_NAMES = [
     'Adristyrannus', 'Aleurocanthus spiniferus', 'Ampelophaga', 'Aphis citricola Vander Goot', 'Apolygus lucorum', 'Bactrocera tsuneonis', 'Beet spot flies', 'Black hairy', 'Brevipoalpus lewisi McGregor', 'Ceroplastes rubens', 'Chlumetia transversa', 'Chrysomphalus aonidum', 'Cicadella viridis', 'Cicadellidae', 'Colomerus vitis', 'Dacus dorsalis(Hendel)', 'Dasineura sp', 'Deporaus marginatus Pascoe', 'Erythroneura apicalis', 'Field Cricket', 'Fruit piercing moth', 'Gall fly', 'Icerya purchasi Maskell', 'Indigo caterpillar', 'Jute Stem Weevil', 'Jute aphid', 'Jute hairy', 'Jute red mite', 'Jute semilooper', 'Jute stem girdler', 'Jute stick insect', 'Lawana imitata Melichar', 'Leaf beetle', 'Limacodidae', 'Locust', 'Locustoidea', 'Lycorma delicatula', 'Mango flat beak leafhopper', 'Mealybug', 'Miridae', 'Nipaecoccus vastalor', 'Panonchus citri McGregor', 'Papilio xuthus', 'Parlatoria zizyphus Lucus', 'Phyllocnistis citrella Stainton', 'Phyllocoptes oleiverus ashmead', 'Pieris canidia', 'Pod borer', 'Polyphagotars onemus latus', 'Potosiabre vitarsis', 'Prodenia litura', 'Pseudococcus comstocki Kuwana', 'Rhytidodera bowrinii white', 'Rice Stemfly', 'Salurnis marginella Guerr', 'Scirtothrips dorsalis Hood', 'Spilosoma Obliqua', 'Sternochetus frigidus', 'Termite', 'Termite odontotermes (Rambur)', 'Tetradacus c Bactrocera minax', 'Thrips', 'Toxoptera aurantii', 'Toxoptera citricidus', 'Trialeurodes vaporariorum', 'Unaspis yanonensis', 'Viteus vitifoliae', 'Xylotrechus', 'Yellow Mite', 'alfalfa plant bug', 'alfalfa seed chalcid', 'alfalfa weevil', 'aphids', 'army worm', 'asiatic rice borer', 'beet army worm', 'beet fly', 'beet weevil', 'beetle', 'bird cherry-oataphid', 'black cutworm', 'blister beetle', 'bollworm', 'brown plant hopper', 'cabbage army worm', 'cerodonta denticornis', 'corn borer', 'corn earworm', 'cutworm', 'english grain aphid', 'fall armyworm', 'flax budworm', 'flea beetle', 'grain spreader thrips', 'grasshopper', 'green bug', 'grub', 'large cutworm', 'legume blister beetle', 'longlegged spider mite', 'lytta polita', 'meadow moth', 'mites', 'mole cricket', 'odontothrips loti', 'oides decempunctata', 'paddy stem maggot', 'parathrene regalis', 'peach borer', 'penthaleus major', 'red spider', 'rice gall midge', 'rice leaf caterpillar', 'rice leaf roller', 'rice leafhopper', 'rice shell pest', 'rice water weevil', 'sawfly', 'sericaorient alismots chulsky', 'small brown plant hopper', 'stem borer', 'tarnished plant bug', 'therioaphis maculata Buckton', 'wheat blossom midge', 'wheat phloeothrips', 'wheat sawfly', 'white backed plant hopper', 'white margined moth', 'whitefly', 'wireworm', 'yellow cutworm', 'yellow rice borer'
 ]
@@ -21,36 +90,112 @@ CLASS_NAMES = [
 class PestNameRequest(BaseModel):
     pest_name: str
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    print("--- Loading models ---")
-    load_dotenv()
+def create_gemini_model():
+    import google.generativeai as genai  # deferred: the SDK is slow to import and only needed on a knowledge-base miss
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+def get_gemini_model():
+    """The Gemini client, created on first use (normally right after start-up, in the background)."""
+    if "gemini_model" not in ml_models:
+        try:
+            ml_models["gemini_model"] = create_gemini_model()
+            print("✅ Gemini API configured successfully.")
+        except Exception as e:
+            print(f"❌ ERROR: Could not configure Gemini API. Is .env file present? Error: {e}")
+            ml_models["gemini_model"] = None
+    return ml_models["gemini_model"]
+
+def build_data_transforms():
+    """The training-time preprocessing, used for parity samples and benchmarks; serving uses preprocessing.py."""
+    from torchvision import transforms  # deferred: importing torchvision costs about a second
+    return transforms.Compose([
+        transforms.Resize((IMG_SIZE, IMG_SIZE)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+
+async def load_models():
+    """
+    Loads, wraps and warms up the classifier while the server is already answering `/` (liveness);
+    `/ready` reports 200 once this has finished.
+    """
     try:
-        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-        ml_models["gemini_model"] = genai.GenerativeModel('gemini-1.5-flash')
-        print("✅ Gemini API configured successfully.")
+        if not os.path.exists(MODEL_PATH):
+            print(f"ERROR: Local pest classifier not found at {MODEL_PATH}")
+            ml_models["pest_classifier"] = None
+            readiness.update(status="unavailable", detail=f"Classifier checkpoint not found at {MODEL_PATH}.")
+            return
+
+        # Deferred: torch takes seconds to import, and `/`, /recommend, /pests and /search never need it.
+        with startup_phase("import_inference"):
+            inference = await asyncio.to_thread(importlib.import_module, "inference")
+        init_worker, classify_in_worker, warm_up = inference.init_worker, inference.classify_in_worker, inference.warm_up
+        load_worker = partial(
+            init_worker, MODEL_PATH, NUM_CLASSES, CLASS_NAMES, INFERENCE_TORCH_THREADS, backend=INFERENCE_BACKEND,
+            channels_last=CHANNELS_LAST, export_dir=BACKEND_EXPORT_DIR, img_size=IMG_SIZE,
+            parity_transform=build_data_transforms() if PARITY_SAMPLES_DIR else None, parity_dir=PARITY_SAMPLES_DIR,
+            cascade=CASCADE, source_path=MODEL_SOURCE_PATH,
+        )
+        if INFERENCE_EXECUTOR == "process":
+            # Each worker process loads its own copy of the model in its initializer, on its first task.
+            inference_pool = WorkerPool("process", INFERENCE_MAX_CONCURRENCY, initializer=load_worker)
+            model, device = "process-pool", "cpu"
+        else:
+            with startup_phase("load_model"):
+                model, device = await asyncio.to_thread(load_worker)
+            inference_pool = WorkerPool("thread", INFERENCE_MAX_CONCURRENCY, name="inference")
+        ml_models["inference_pool"] = inference_pool
+        ml_models["preprocess_pool"] = WorkerPool("thread", PREPROCESS_WORKERS, name="preprocess")
+        if WARMUP_BATCH_SIZE:
+            # One call per concurrency slot, so every process worker gets spawned and loads its model now.
+            with startup_phase("warmup"):
+                await asyncio.gather(*(
+                    inference_pool.run(warm_up, sorted({1, WARMUP_BATCH_SIZE}), IMG_SIZE) for _ in range(INFERENCE_MAX_CONCURRENCY)
+                ))
+        cascade_tag = f"+cascade:{CASCADE_MODEL_PATH or CASCADE_IMG_SIZE}:{CASCADE_THRESHOLD}" if CASCADE else ""
+        prediction_cache.set_model_version(model_version(MODEL_PATH, INFERENCE_BACKEND + cascade_tag))
+        batcher = MicroBatcher(
+            partial(classify_in_worker, k=3),
+            max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, max_queue_size=BATCH_MAX_QUEUE,
+            pool=inference_pool, max_concurrent_batches=INFERENCE_MAX_CONCURRENCY, on_batch=record_batch,
+        )
+        await batcher.start()
+        ml_models["batcher"] = batcher
+        ml_models["device"] = device
+        ml_models["class_names"] = CLASS_NAMES
+        ml_models["pest_classifier"] = model
+        readiness.update(status="ready", detail=None)
+        record_startup_phase("time_to_ready", time.perf_counter() - IMPORT_START)
+        print(f"--- Models loaded successfully on device: {device} ---")
     except Exception as e:
-        print(f"❌ ERROR: Could not configure Gemini API. Is .env file present? Error: {e}")
-        ml_models["gemini_model"] = None
+        print(f"❌ ERROR: Could not load the pest classifier: {e}")
+        readiness.update(status="failed", detail=f"Could not load the pest classifier: {e}")
+    finally:
+        with startup_phase("gemini_client"):
+            await asyncio.to_thread(get_gemini_model)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print("--- Starting up ---")
+    record_startup_phase("imports", IMPORT_DONE - IMPORT_START)
+    with startup_phase("knowledge_base"):
+        catalog = PestCatalog(KNOWLEDGE_BASE_PATH, KNOWLEDGE_BASE_READ_POOL)
+        catalog.sync(CLASS_NAMES)
+    ml_models["pest_catalog"] = catalog
+    ml_models["recommendation_store"] = RecommendationStore(KNOWLEDGE_BASE_PATH, RECOMMENDATION_CACHE_TTL_DAYS, catalog=catalog)
+    print(f"✅ Knowledge base ready: {len(catalog.aliases)} pest aliases, search {'on' if catalog.search_enabled else 'off'}.")
+    readiness.update(status="loading", detail="Loading the pest classifier.")
+    loader = asyncio.create_task(load_models())
 
-    model = timm.create_model('convnext_tiny_in22k', pretrained=False, num_classes=NUM_CLASSES)
-    try:
-        model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu')))
-    except FileNotFoundError:
-        print(f"ERROR: Local pest classifier not found at {MODEL_PATH}")
-        ml_models["pest_classifier"] = None
-        yield
-        return
-        
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device); model.eval()
-    ml_models["pest_classifier"] = model
-    ml_models["device"] = device
-    ml_models["class_names"] = CLASS_NAMES
-    print(f"--- Models loaded successfully on device: {device} ---")
-    
     yield
-    
+
+    loader.cancel()
+    await asyncio.gather(loader, return_exceptions=True)
+    if "batcher" in ml_models: await ml_models["batcher"].stop()
+    for pool in ("inference_pool", "preprocess_pool"):
+        if pool in ml_models: ml_models[pool].shutdown()
+    catalog.close()
     ml_models.clear()
 
 app = FastAPI(title="Pest Classification API", lifespan=lifespan)
@@ -60,34 +205,180 @@ app.add_middleware(
     allow_methods=["*"], allow_headers=["*"],
 )
 
-data_transforms = transforms.Compose([
-    transforms.Resize((IMG_SIZE, IMG_SIZE)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
+async def reject_oversized_uploads(request, call_next):
+    # Refuse on Content-Length alone, before the multipart body is parsed and spooled.
+    if request.url.path.startswith("/predict"):
+        files = PREDICT_BATCH_MAX_FILES if request.url.path == "/predict/batch" else 1
+        try:
+            content_length = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            ERRORS_TOTAL.inc(where="bad_content_length")
+            return JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+        if content_length > MAX_UPLOAD_BYTES * files + (64 << 10):
+            ERRORS_TOTAL.inc(where="upload_too_large")
+            return JSONResponse(status_code=413, content={"detail": "Upload is too large."})
+    return await call_next(request)
+
+# The last middleware added runs outermost: TimingMiddleware also sees the rejections above.
+app.add_middleware(BaseHTTPMiddleware, dispatch=reject_oversized_uploads)
+app.add_middleware(TimingMiddleware)
 
 @app.get("/")
 def home():
     return {"message": "API is running. Go to /docs for interface."}
 
+@app.get("/ready")
+def ready():
+    """Readiness, unlike `/` (liveness): 200 only once the classifier is loaded and warmed up."""
+    body = {"status": readiness["status"], "detail": readiness["detail"], "startup_seconds": STARTUP_PHASES}
+    return JSONResponse(body, status_code=200 if readiness["status"] == "ready" else 503)
+
+def require_classifier():
+    if ml_models.get("pest_classifier"): return
+    if readiness["status"] == "loading":
+        raise HTTPException(status_code=503, detail="Model is still loading.", headers={"Retry-After": str(BATCH_RETRY_AFTER_S)})
+    raise HTTPException(status_code=500, detail="Model is not loaded.")
+
+async def classify_upload(contents, retries=0):
+    """
+    Returns {"predictions": top-3, "stage"} for one upload, from the prediction cache when possible,
+    otherwise by decoding it and waiting on the micro-batcher. Retries a full queue `retries` times with a short backoff.
+    """
+    pool = ml_models["preprocess_pool"]
+    digest = await pool.run(content_hash, contents)
+    use_phash = prediction_cache.enabled and prediction_cache.mode == "phash"
+    result = prediction_cache.get(digest, record_miss=not use_phash)
+    if result is not None: return result
+    if use_phash:
+        image = await pool.run(load_image, contents, IMG_SIZE, MAX_IMAGE_PIXELS)
+        image_digest = await pool.run(perceptual_hash, image)
+        result = prediction_cache.get(image_digest)
+        if result is not None:
+            prediction_cache.put(digest, result)
+            return result
+        image_tensor = await pool.run(to_uint8_tensor, image)
+    else:
+        image_digest = None
+        image_tensor = await pool.run(preprocess_upload, contents, IMG_SIZE, MAX_IMAGE_PIXELS)
+    for attempt in range(retries + 1):
+        try:
+            with timed("inference_wait"):
+                result = await ml_models["batcher"].submit(image_tensor)
+            break
+        except QueueFullError:
+            if attempt == retries: raise
+            await asyncio.sleep(BATCH_MAX_WAIT_MS / 1000.0 * (attempt + 1) * 4)
+    prediction_cache.put(digest, result)
+    if image_digest: prediction_cache.put(image_digest, result)
+    return result
+
+def prediction_body(result):
+    """Response fields for one classified image: the top-3 with each class's knowledge-base PestID, and which cascade stage answered."""
+    label_ids = ml_models["pest_catalog"].label_ids
+    predictions = [{**prediction, "pest_id": label_ids.get(prediction["class_name"])} for prediction in result["predictions"]]
+    return {"predictions": predictions, "stage": result["stage"]}
+
 @app.post("/predict")
 async def predict(file: UploadFile = File(...)):
-    if not ml_models.get("pest_classifier"): raise HTTPException(status_code=500, detail="Model is not loaded.")
-    contents = await file.read(); image = Image.open(io.BytesIO(contents)).convert("RGB")
-    image_tensor = data_transforms(image).unsqueeze(0).to(ml_models["device"])
-    with torch.no_grad():
-        outputs = ml_models["pest_classifier"](image_tensor)
-        probabilities = torch.nn.functional.softmax(outputs[0], dim=0)
-        top3_conf, top3_indices = torch.topk(probabilities, 3)
-    predictions = [{"class_name": ml_models["class_names"][idx], "confidence": round(conf.item(), 4)} for idx, conf in zip(top3_indices, top3_conf)]
-    return {"filename": file.filename, "predictions": predictions}
+    require_classifier()
+    try:
+        with timed("upload_read"):
+            contents = await read_upload(file, MAX_UPLOAD_BYTES)
+        result = await classify_upload(contents)
+    except (UploadTooLarge, OSError) as e:
+        too_large = isinstance(e, UploadTooLarge)
+        ERRORS_TOTAL.inc(where="upload_too_large" if too_large else "image_decode")
+        raise HTTPException(status_code=413 if too_large else 400, detail=image_error_detail(e))
+    except QueueFullError as e:
+        ERRORS_TOTAL.inc(where="queue_full")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(BATCH_RETRY_AFTER_S)})
+    return {"filename": file.filename, **prediction_body(result)}
 
-@app.post("/recommend")
-async def recommend(request: PestNameRequest):
-    gemini_model = ml_models.get("gemini_model")
-    if not gemini_model: raise HTTPException(status_code=500, detail="Gemini model not available.")
-    pest_name = request.pest_name.replace('_', ' ').title()
-    prompt = f"""
+@app.post("/predict/batch")
+async def predict_batch(files: List[UploadFile] = File(...)):
+    """Classifies many images from one multipart upload, streaming one NDJSON line per image as it finishes."""
+    require_classifier()
+    if len(files) > PREDICT_BATCH_MAX_FILES:
+        ERRORS_TOTAL.inc(where="upload_too_large")
+        raise HTTPException(status_code=413, detail=f"Too many files; at most {PREDICT_BATCH_MAX_FILES} per request.")
+    # Read everything up front: the upload's temp files are closed once this handler returns.
+    try:
+        uploads = [(index, file.filename, await read_upload(file, MAX_UPLOAD_BYTES)) for index, file in enumerate(files)]
+    except UploadTooLarge as e:
+        ERRORS_TOTAL.inc(where="upload_too_large")
+        raise HTTPException(status_code=413, detail=str(e))
+    in_flight = asyncio.Semaphore(PREDICT_BATCH_IN_FLIGHT)
+
+    async def classify(index, filename, contents):
+        async with in_flight:
+            try:
+                return {"index": index, "filename": filename, **prediction_body(await classify_upload(contents, retries=3))}
+            except QueueFullError:
+                ERRORS_TOTAL.inc(where="queue_full")
+                return {"index": index, "filename": filename, "error": "Server busy, retry this image."}
+            except (UploadTooLarge, OSError) as e:
+                ERRORS_TOTAL.inc(where="upload_too_large" if isinstance(e, UploadTooLarge) else "image_decode")
+                return {"index": index, "filename": filename, "error": image_error_detail(e)}
+            except Exception as e:
+                ERRORS_TOTAL.inc(where="predict_batch_item")
+                print(f"❌ ERROR: Could not classify '{filename}' in /predict/batch: {e}")
+                return {"index": index, "filename": filename, "error": "Could not process image."}
+
+    async def stream():
+        tasks = [asyncio.create_task(classify(*upload)) for upload in uploads]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            for task in tasks: task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/stats")
+def stats():
+    batcher = ml_models.get("batcher")
+    store = ml_models.get("recommendation_store")
+    return {
+        "batching": batcher.stats() if batcher else None,
+        "prediction_cache": prediction_cache.stats(),
+        "recommendations": store.stats() if store else None,
+        "cascade": cascade_stats(),
+    }
+
+def cascade_stats():
+    """Escalation rate and first-stage / full-model top-1 agreement, for tuning CASCADE_THRESHOLD."""
+    if not CASCADE: return None
+    count = lambda event: CASCADE_IMAGES.value(event=event)
+    images, escalated, audited = count("images"), count("escalated"), count("audited")
+    return {
+        "threshold": CASCADE_THRESHOLD, "img_size": CASCADE_IMG_SIZE, "model_path": CASCADE_MODEL_PATH,
+        "images": images, "escalated": escalated, "escalation_rate": round(escalated / images, 4) if images else None,
+        # Agreement on a random sample of the images the first stage answered alone
+        "audited": audited, "audit_agreement": round(count("audit_agreed") / audited, 4) if audited else None,
+        # How often escalating changed the top-1 the first stage would have given
+        "escalation_changed_rate": round(count("escalation_changed") / escalated, 4) if escalated else None,
+    }
+
+@app.get("/pests/{name}")
+def get_pest(name: str):
+    """A knowledge-base pest by any known name: classifier label, common or scientific name, any casing."""
+    catalog = ml_models["pest_catalog"]
+    if not catalog.available: raise HTTPException(status_code=503, detail="The knowledge base is not available.")
+    pest = catalog.get_pest(name)
+    if pest is None: raise HTTPException(status_code=404, detail=f"No pest named '{name}' in the knowledge base.")
+    return pest
+
+@app.get("/search")
+def search(q: str = Query(..., min_length=1, max_length=200), limit: int = Query(20, ge=1, le=100)):
+    """Full-text search over pest names, descriptions and recommendations, best matches first."""
+    catalog = ml_models["pest_catalog"]
+    if not catalog.search_enabled: raise HTTPException(status_code=503, detail="Full-text search is not available.")
+    return {"query": q, "results": catalog.search(q, limit)}
+
+def build_prompt(pest_name):
+    return f"""
     You are an expert agricultural entomologist providing advice for farmers in India.
     Generate a detailed information sheet for the pest: "{pest_name}".
     Structure your response exactly as follows, using these specific markdown headers:
@@ -104,38 +395,86 @@ async def recommend(request: PestNameRequest):
     # PREVENTION TIPS
     (Provide a bulleted list of actionable prevention tips.)
     """
-    try:
+
+def collect_component_metrics():
+    cache_stats = prediction_cache.stats()
+    for event in ("hits", "misses", "evictions", "expirations", "invalidations"):
+        CACHE_EVENTS.set(cache_stats[event], cache="prediction", event=event)
+    store = ml_models.get("recommendation_store")
+    if store:
+        for event, count in store.stats().items():
+            if event != "in_flight": CACHE_EVENTS.set(count, cache="recommendation", event=event)
+    batcher = ml_models.get("batcher")
+    if batcher:
+        QUEUE_DEPTH.set(batcher.queue_depth)
+        ERRORS_TOTAL.set(batcher.stats()["errors"], where="inference_batch")
+
+REGISTRY.add_collector(collect_component_metrics)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/recommend")
+async def recommend(request: PestNameRequest):
+    pest_name = request.pest_name.replace('_', ' ').title()
+
+    async def generate():
+        gemini_model = get_gemini_model()
+        if not gemini_model: raise HTTPException(status_code=500, detail="Gemini model not available.")
         print(f"--- Generating recommendation for {pest_name} ---")
-        response = await gemini_model.generate_content_async(prompt)
-        text = response.text
-        
-        def parse_section(header, content):
-            try:
-                section_content = re.search(f'# {header}\n(.*?)(?=\n# |$)', content, re.DOTALL).group(1).strip()
-                lines = [line.strip() for line in section_content.split('\n') if line.strip()]
-                def clean_line(line): return line.strip('-* ').replace('**', '')
-                if header == "CHEMICAL SOLUTIONS":
-                    solutions = []
-                    for line in lines:
-                        if "CRITICAL DISCLAIMER" in line.upper(): continue
-                        cleaned = clean_line(line)
-                        parts = cleaned.split(':', 1)
-                        if len(parts) == 2: pesticide, notes = parts[0].strip(), parts[1].strip()
-                        else: pesticide, notes = cleaned, "Consult packaging for detailed information."
-                        solutions.append({"pesticide": pesticide, "dosage": "As per local guidelines", "notes": notes})
-                    return solutions
-                else: return [clean_line(line) for line in lines]
-            except: return []
-
-        response_payload = {
-            "pest_name": pest_name,
-            "pest_info": re.search(r'# PEST INFO\n(.*?)(?=\n# |$)', text, re.DOTALL).group(1).strip() if re.search(r'# PEST INFO\n(.*?)(?=\n# |$)', text, re.DOTALL) else "Information not available.",
-            "ipm_solutions": parse_section("IPM SOLUTIONS", text),
-            "chemical_solutions": parse_section("CHEMICAL SOLUTIONS", text),
-            "prevention_tips": parse_section("PREVENTION TIPS", text),
-        }
-        return response_payload
+        with timed("gemini_call"):
+            response = await gemini_model.generate_content_async(build_prompt(pest_name))
+        with timed("markdown_parse"):
+            return parse_recommendation(pest_name, response.text)
+
+    try:
+        return await ml_models["recommendation_store"].get(pest_name, generate)
+    except HTTPException:
+        raise
     except Exception as e:
+        ERRORS_TOTAL.inc(where="recommend")
         print(f"❌ ERROR: Failed to generate or parse Gemini response: {e}")
         raise HTTPException(status_code=500, detail="Failed to get recommendation from AI service.")
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/recommend/stream")
+async def recommend_stream(request: PestNameRequest):
+    """
+    Same content as /recommend, as Server-Sent Events: a `section` event per section as soon as it
+    is complete, then `done` with the full /recommend payload (or `error`).
+    """
+    pest_name = request.pest_name.replace('_', ' ').title()
+
+    async def generate_stream(emit):
+        gemini_model = get_gemini_model()
+        if not gemini_model: raise RuntimeError("Gemini model not available.")
+        print(f"--- Streaming recommendation for {pest_name} ---")
+        parser, parse_seconds, start = SectionParser(), 0.0, time.perf_counter()
+        response = await gemini_model.generate_content_async(build_prompt(pest_name), stream=True)
+        async for chunk in response:
+            parse_start = time.perf_counter()
+            completed = parser.feed(chunk.text)
+            parse_seconds += time.perf_counter() - parse_start
+            for section, value in completed: emit(section, value)
+        for section, value in parser.close(): emit(section, value)
+        record("gemini_call", time.perf_counter() - start - parse_seconds)
+        record("markdown_parse", parse_seconds)
+        return parser.payload(pest_name)
+
+    async def events():
+        payload = {"pest_name": pest_name}
+        try:
+            async for section, value in ml_models["recommendation_store"].stream(pest_name, generate_stream):
+                payload[section] = value
+                yield sse_event("section", {"section": section, "value": value})
+        except Exception as e:
+            ERRORS_TOTAL.inc(where="recommend_stream")
+            print(f"❌ ERROR: Failed to stream Gemini response: {e}")
+            yield sse_event("error", {"detail": "Failed to get recommendation from AI service."})
+            return
+        yield sse_event("done", {**parse_recommendation(pest_name, ""), **payload})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,223 @@
+"""
+Lightweight, always-on instrumentation rendered in the Prometheus text format at /metrics.
+
+Metrics are plain in-process counters guarded by a lock, cheap enough for the hot path and safe
+to update from executor threads. `record(stage, seconds)` feeds the per-stage histogram and, while
+a request is being served, that request's timings, which `TimingMiddleware` returns in a
+`Server-Timing` header.
+"""
+import bisect, threading, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs: return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock: return self._values.get(self._key(labels), 0)
+
+    def set(self, value, **labels):
+        """For registry collectors mirroring a count that is kept elsewhere."""
+        key = self._key(labels)
+        with self._lock: self._values[key] = value
+
+    def render(self):
+        with self._lock: items = list(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None: counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        with self._lock: items = [(key, list(counts)) for key, counts in self._values.items()]
+        lines = self._header()
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-1]!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """`collect()` runs on every scrape to refresh gauges/counters that mirror state held elsewhere."""
+        self._collectors.append(collect)
+
+    def render(self):
+        for collect in self._collectors:
+            try: collect()
+            except Exception as e: print(f"❌ ERROR: Metrics collector failed: {e}")
+        lines = []
+        for metric in self._metrics: lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "pest_api_stage_seconds", "Time spent in each stage of the request hot paths.", ["stage"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "pest_api_request_seconds", "End-to-end HTTP request latency.", ["method", "route"]))
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "pest_api_requests_total", "HTTP requests served.", ["method", "route", "status"]))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "pest_api_requests_in_flight", "HTTP requests currently being served."))
+ERRORS_TOTAL = REGISTRY.register(Counter(
+    "pest_api_errors_total", "Errors by where they happened.", ["where"]))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "pest_api_batch_size", "Images per forward pass.", buckets=(1, 2, 4, 8, 16, 32, 64)))
+CACHE_EVENTS = REGISTRY.register(Counter(
+    "pest_api_cache_events_total", "Cache lookups and maintenance events.", ["cache", "event"]))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "pest_api_batch_queue_depth", "Images waiting for a forward pass."))
+CASCADE_IMAGES = REGISTRY.register(Counter(
+    "pest_api_cascade_images_total", "Cascade inference: images, escalations and first-stage audits.", ["event"]))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    "pest_api_startup_seconds", "Duration of each start-up phase of this process.", ["phase"]))
+STARTUP_PHASES = {}
+
+
+def record(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None: timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def startup_phase(phase):
+    """Times one start-up phase: logged, exported as a gauge and kept in STARTUP_PHASES for /ready."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup_phase(phase, time.perf_counter() - start)
+
+
+def record_startup_phase(phase, seconds):
+    STARTUP_PHASES[phase] = round(seconds, 4)
+    STARTUP_SECONDS.set(seconds, phase=phase)
+    print(f"--- ⏱️ {phase}: {seconds * 1000:.0f} ms ---")
+
+
+def record_batch(info, batch_size):
+    """Observes the stage timings (and cascade counts) reported by an inference worker for one whole batch."""
+    BATCH_SIZE.observe(batch_size)
+    for stage, seconds in info["timings"].items(): STAGE_SECONDS.observe(seconds, stage=stage)
+    for event, count in info.get("cascade", {}).items(): CASCADE_IMAGES.inc(count, event=event)
+
+
+class TimingMiddleware:
+    """
+    Pure ASGI middleware: counts in-flight requests, observes request latency per route and adds a
+    `Server-Timing` header with the stages recorded while serving the request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def _route(self, scope):
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL: return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        timings = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_timings(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items()]
+                entries.append(f"app;dur={(time.perf_counter() - start) * 1000:.2f}")
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"server-timing", ", ".join(entries).encode())]}
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            IN_FLIGHT.dec()
+            _request_timings.reset(token)
+            route = self._route(scope)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, method=scope["method"], route=route)
+            REQUESTS_TOTAL.inc(method=scope["method"], route=route, status=status[0])
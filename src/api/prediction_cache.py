@@ -0,0 +1,101 @@
+import hashlib, os, time
+from collections import OrderedDict
+
+
+def model_version(model_path, backend="eager"):
+    """Identifies the loaded weights; any change to the checkpoint file or its path yields a new version."""
+    st = os.stat(model_path)
+    return f"{os.path.realpath(model_path)}:{st.st_mtime_ns}:{st.st_size}:{backend}"
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """sha256 of a file's contents, read in chunks; shared by the model exports and the data scripts."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_hash(contents):
+    return hashlib.sha256(contents).hexdigest()
+
+
+def perceptual_hash(image, hash_size=8):
+    """
+    64-bit difference hash (dHash) of a PIL image. Re-encoded or re-compressed copies of the
+    same photo almost always produce the same value, unlike a hash of the raw bytes.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left, right = pixels[row * (hash_size + 1) + col], pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"p{bits:016x}"
+
+
+class PredictionCache:
+    """
+    In-process LRU cache of top-k predictions keyed on (model version, image hash), with a size
+    limit and a TTL. Switching to a new model version drops every entry of the previous one.
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    MODES = ("sha256", "phash")
+
+    def __init__(self, max_entries=2048, ttl_seconds=3600, mode="sha256"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown prediction cache mode '{mode}'. Use one of {', '.join(self.MODES)}.")
+        self.max_entries, self.ttl, self.mode = max_entries, ttl_seconds, mode
+        self.model_version = None
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def set_model_version(self, version):
+        if version != self.model_version and self._entries:
+            self._entries.clear()
+            self._stats["invalidations"] += 1
+        self.model_version = version
+
+    def get(self, digest, record_miss=True):
+        """Cached predictions for `digest`, or None. Pass record_miss=False when a fallback lookup follows."""
+        if not self.enabled: return None
+        key = (self.model_version, digest)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            self._stats["expirations"] += 1
+            entry = None
+        if entry is None:
+            if record_miss: self._stats["misses"] += 1
+            return None
+        predictions = entry[1]
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return predictions
+
+    def put(self, digest, predictions):
+        if not self.enabled: return
+        key = (self.model_version, digest)
+        self._entries[key] = (time.monotonic() + self.ttl, predictions)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "mode": self.mode,
+            "model_version": self.model_version,
+        }
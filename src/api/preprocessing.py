@@ -0,0 +1,96 @@
+"""
+Upload reading and image preprocessing for the serving path.
+
+Uploads are read in chunks against a byte limit, and the pixel count is checked from the image
+header before anything is decoded. JPEGs are decoded in draft mode, which lets libjpeg's DCT
+scaling produce an image close to the model's input size instead of the full 12MP frame.
+Workers hand the batcher small uint8 (H, W, 3) tensors; `normalize_batch` converts and
+normalizes them straight into a per-thread, preallocated float batch buffer, which replaces the
+ToTensor / Normalize allocations of `main.build_data_transforms()`.
+"""
+import io, threading
+from PIL import Image, UnidentifiedImageError
+from metrics import timed
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+READ_CHUNK_BYTES = 1 << 20
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the byte or pixel limit."""
+
+
+def image_error_detail(e):
+    """
+    The client-facing message for an upload that is too large or can't be decoded, or None if `e`
+    is some other error. UnidentifiedImageError is checked first; it is also an OSError.
+    """
+    if isinstance(e, (UploadTooLarge, Image.DecompressionBombError)): return str(e)
+    if isinstance(e, UnidentifiedImageError): return "Uploaded file is not a supported image."
+    # Truncated or corrupt image data that PIL only notices while decoding.
+    if isinstance(e, OSError): return f"Uploaded image could not be decoded: {e}"
+    return None
+
+
+async def read_upload(file, max_bytes):
+    """Reads an UploadFile chunk by chunk, giving up as soon as it grows past `max_bytes`."""
+    chunks, total = [], 0
+    while True:
+        chunk = await file.read(READ_CHUNK_BYTES)
+        if not chunk: break
+        total += len(chunk)
+        if total > max_bytes:
+            raise UploadTooLarge(f"Upload is larger than the {max_bytes // (1 << 20)} MB limit.")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def load_image(contents, size, max_pixels):
+    """
+    Decodes image bytes to an RGB PIL image of exactly (size, size), decoding JPEGs at reduced scale.
+    Raises UploadTooLarge for oversized images and OSError for unreadable or truncated ones.
+    """
+    with timed("image_decode"):
+        try:
+            image = Image.open(io.BytesIO(contents))
+        except Image.DecompressionBombError as e:
+            raise UploadTooLarge(str(e))
+        if image.width * image.height > max_pixels:
+            raise UploadTooLarge(f"Image is {image.width}x{image.height}; the limit is {max_pixels} pixels.")
+        # No-op for formats other than JPEG. Picks the largest DCT scale that still leaves both sides >= size.
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+        return image.resize((size, size), Image.BILINEAR)
+
+
+def to_uint8_tensor(image):
+    """(H, W, 3) uint8 tensor view of a PIL RGB image."""
+    import numpy as np, torch  # deferred: importing main must not load torch (see main.load_models)
+    with timed("transform"):
+        return torch.from_numpy(np.array(image, dtype=np.uint8))
+
+
+def preprocess_upload(contents, size, max_pixels):
+    return to_uint8_tensor(load_image(contents, size, max_pixels))
+
+
+_buffers = threading.local()
+
+
+def normalize_batch(images):
+    """
+    Packs uint8 (H, W, 3) tensors into this thread's reusable (N, 3, H, W) float32 buffer and
+    normalizes it in place. The returned view is only valid until this thread's next call.
+    """
+    import torch
+    count, (height, width, _) = len(images), images[0].shape
+    buffer = getattr(_buffers, "batch", None)
+    if buffer is None or buffer.shape[0] < count or buffer.shape[2:] != (height, width):
+        buffer = _buffers.batch = torch.empty(max(count, 8), 3, height, width)
+        _buffers.mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1) * 255.0
+        _buffers.inv_std = 1.0 / (torch.tensor(IMAGENET_STD).view(1, 3, 1, 1) * 255.0)
+    batch = buffer[:count]
+    for slot, image in zip(batch, images):
+        slot.copy_(image.permute(2, 0, 1))
+    return batch.sub_(_buffers.mean).mul_(_buffers.inv_std)
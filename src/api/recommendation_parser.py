@@ -0,0 +1,90 @@
+import re
+
+# Markdown headers Gemini is asked to use (see main.build_prompt) and the payload keys they fill.
+SECTION_HEADERS = {
+    "PEST INFO": "pest_info",
+    "IPM SOLUTIONS": "ipm_solutions",
+    "CHEMICAL SOLUTIONS": "chemical_solutions",
+    "PREVENTION TIPS": "prevention_tips",
+}
+PAYLOAD_SECTIONS = tuple(SECTION_HEADERS.values())
+HEADER_LINE = re.compile(r'^#+\s*(.*?)\s*#*\s*$')
+
+
+def clean_line(line):
+    return line.strip('-* ').replace('**', '')
+
+
+def parse_section_lines(key, lines):
+    """Turns the raw lines under one header into that section's payload value."""
+    if key == "pest_info":
+        return "\n".join(lines).strip()
+    lines = [line.strip() for line in lines if line.strip()]
+    if key != "chemical_solutions":
+        return [clean_line(line) for line in lines]
+    solutions = []
+    for line in lines:
+        if "CRITICAL DISCLAIMER" in line.upper(): continue
+        cleaned = clean_line(line)
+        parts = cleaned.split(':', 1)
+        if len(parts) == 2: pesticide, notes = parts[0].strip(), parts[1].strip()
+        else: pesticide, notes = cleaned, "Consult packaging for detailed information."
+        solutions.append({"pesticide": pesticide, "dosage": "As per local guidelines", "notes": notes})
+    return solutions
+
+
+class SectionParser:
+    """
+    Single-pass, incremental parser for Gemini's recommendation markdown.
+
+    `feed()` accepts arbitrary text chunks and returns the (key, value) pairs of every section that
+    is complete, i.e. whose next header has arrived; `close()` flushes the last one. Content under
+    unknown top-level (`# `) headers is ignored, the same as the old regex-based parser.
+    """
+
+    def __init__(self):
+        self.sections = {}
+        self._pending = ""
+        self._key = None
+        self._lines = []
+
+    def _finish(self):
+        if self._key is None: return []
+        key, value = self._key, parse_section_lines(self._key, self._lines)
+        self._key, self._lines = None, []
+        self.sections[key] = value
+        return [(key, value)]
+
+    def _line(self, line):
+        match = HEADER_LINE.match(line) if line.startswith('#') else None
+        if match and (match.group(1).upper() in SECTION_HEADERS or line.startswith('# ')):
+            completed = self._finish()
+            key = SECTION_HEADERS.get(match.group(1).upper())
+            if key is not None and key not in self.sections: self._key = key
+            return completed
+        if self._key is not None: self._lines.append(line)
+        return []
+
+    def feed(self, chunk):
+        completed = []
+        *lines, self._pending = (self._pending + chunk).split('\n')
+        for line in lines: completed.extend(self._line(line.rstrip('\r')))
+        return completed
+
+    def close(self):
+        completed = self._line(self._pending) if self._pending else []
+        self._pending = ""
+        return completed + self._finish()
+
+    def payload(self, pest_name):
+        return {
+            "pest_name": pest_name,
+            "pest_info": self.sections.get("pest_info") or "Information not available.",
+            **{key: self.sections.get(key, []) for key in PAYLOAD_SECTIONS[1:]},
+        }
+
+
+def parse_recommendation(pest_name, text):
+    parser = SectionParser()
+    parser.feed(text); parser.close()
+    return parser.payload(pest_name)
@@ -0,0 +1,93 @@
+"""
+Multi-worker launcher that keeps a single copy of the model weights in memory.
+
+    python serve.py --workers 4 --host 0.0.0.0 --port 8000
+
+Plain `uvicorn main:app --workers N` has every worker load the checkpoint on its own. Here it is
+loaded once, before the workers start, and re-saved to a memory-backed file (/dev/shm when
+available) in the layout the workers run with. Each worker's lifespan memory-maps that file
+(see inference.load_state_dict) and runs on its pages directly, so all workers share one physical
+copy; the mapping is copy-on-write, so a stray in-place write stays private to one worker.
+
+Torch intra-op threads are split between the workers (and their INFERENCE_MAX_CONCURRENCY forward
+passes) so N workers never run more compute threads than there are cores. Sharing covers the
+eager and compile backends; onnx, torchscript and int8 build a private copy in every worker. The
+onnx and torchscript exports are made here, once, and named after the original checkpoint, so
+the workers and later launches load them instead of exporting again.
+"""
+import argparse, hashlib, multiprocessing, os, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import uvicorn
+
+SHARED_WEIGHTS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SHARED_BACKENDS = ("eager", "compile")
+EXPORTED_BACKENDS = ("onnx", "torchscript")
+
+
+def shared_weights_path(model_path, channels_last, owner_pid):
+    """
+    One file per launcher process, checkpoint version and layout. The launcher deletes it on exit,
+    so two launchers on one host must never share it.
+    """
+    stat = os.stat(model_path)
+    key = f"{os.path.abspath(model_path)}:{stat.st_mtime_ns}:{stat.st_size}:{channels_last}"
+    return os.path.join(SHARED_WEIGHTS_DIR, f"pest-weights-{hashlib.sha256(key.encode()).hexdigest()[:16]}-{owner_pid}.pt")
+
+
+def prepare_workers(workers, owner_pid):
+    """
+    Reads the API configuration, writes the shared weights (and the onnx / torchscript export) and
+    returns the environment the workers should start with. Runs in a throwaway process, so the
+    supervisor itself never imports torch.
+    """
+    import main
+    from executor import default_torch_threads
+    from inference import save_shared_weights
+
+    threads = default_torch_threads(workers * main.INFERENCE_MAX_CONCURRENCY)
+    env = {"INFERENCE_TORCH_THREADS": str(threads), "OMP_NUM_THREADS": str(threads), "MKL_NUM_THREADS": str(threads)}
+    if not os.path.exists(main.MODEL_PATH):
+        print(f"ERROR: Local pest classifier not found at {main.MODEL_PATH}")
+        return env, None
+    path = save_shared_weights(main.MODEL_PATH, shared_weights_path(main.MODEL_PATH, main.CHANNELS_LAST, owner_pid), main.CHANNELS_LAST)
+    print(f"✅ Model weights shared from '{path}' ({os.path.getsize(path) / (1 << 20):.0f} MB), {threads} torch threads per forward pass.")
+    if main.INFERENCE_BACKEND not in SHARED_BACKENDS:
+        print(f"❌ WARNING: The '{main.INFERENCE_BACKEND}' backend keeps a private copy of the model in every worker.")
+    if main.INFERENCE_BACKEND in EXPORTED_BACKENDS: export_backend(main)
+    return {**env, "MODEL_PATH": path, "MODEL_SOURCE_PATH": os.path.abspath(main.MODEL_PATH)}, path
+
+
+def export_backend(main):
+    """Exports the onnx / torchscript model before the workers start; a worker that finds it current just loads it."""
+    import torch
+    from backends import build_backend
+    from inference import load_classifier
+
+    if torch.cuda.is_available(): return  # GPU workers run the eager model
+    try:
+        model = load_classifier(main.MODEL_PATH, main.NUM_CLASSES, torch.device("cpu"))
+        build_backend(
+            main.INFERENCE_BACKEND, model, os.path.abspath(main.MODEL_PATH), main.IMG_SIZE, main.BACKEND_EXPORT_DIR,
+            channels_last=main.CHANNELS_LAST,
+        )
+    except Exception as e:
+        print(f"❌ ERROR: Could not export the '{main.INFERENCE_BACKEND}' backend up front; the workers will try. Error: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the pest API from several workers sharing one copy of the model.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        env, shared_path = pool.submit(prepare_workers, args.workers, os.getpid()).result()
+    # Workers are fresh interpreters that read their configuration from the environment.
+    os.environ.update(env)
+    print(f"--- Starting {args.workers} workers ---")
+    try:
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        if shared_path and os.path.exists(shared_path): os.remove(shared_path)